@@ -0,0 +1,363 @@
+# benchmark of the data loading, training, perplexity and evaluation stages
+#
+#   python benchmark.py run -f "./data/time/train/0.2-attribute-*.txt" --synthetic 100000 1000000 -o bench.json
+#   python benchmark.py compare baseline.json bench.json --threshold 0.1
+#
+# run writes one record per (stage, case, metric) together with the environment it ran in, compare matches the
+# records of two runs and exits with 1 when a metric got worse by more than the threshold.
+# stages:
+#   load        IdsData() and divide_dataset() of the split
+#   train       steps/sec of every model variant, training scripts run in a temporary directory with --profile
+#   perplexity  calc_score() of the perplexity script on the trained posterior
+#   evaluation  create_location_ranking() and evaluation_pre_and_recall() of the evaluator
+#   memory      memory_planner's estimate of every model against the per-step peak of a few profiled steps, the
+#               stage fails on a case whose estimate is below the peak; not run by default
+#   quantization  size, load time and plugin perplexity of the trained posterior stored with every --codecs codec
+#               (per-row parameters compressed), next to the float32 pkl as .../float32; not run by default
+# stages whose script can not be imported here (missing dependencies) are skipped with a note.
+
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from glob import glob
+from os.path import abspath, join, dirname
+
+import torch
+
+SRC = join(dirname(abspath(__file__)), '..')
+sys.path.append(join(SRC, 'common'))
+sys.path.append(join(SRC, 'learning'))
+sys.path.append(join(SRC, 'perplexsity'))
+import generate_synthetic_data
+import memory_planner
+import posterior_bundle
+import posterior_codec
+
+MODELS = ['base', 's', 't', 'st']
+# model type names of the perplexity scripts
+PERPLEXITY_MODELS = {'base': 'base', 's': 'location', 't': 'timeaware', 'st': 'union'}
+# metrics where larger is better, everything else is a duration
+HIGHER_IS_BETTER = ['steps_per_sec']
+
+
+def environment():
+    env = {
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'host': socket.gethostname(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'torch_threads': torch.get_num_threads(),
+    }
+    for module in ['pyro', 'numpy']:
+        try:
+            env[module] = __import__(module).__version__
+        except ImportError:
+            env[module] = None
+    try:
+        env['git_commit'] = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=SRC,
+                                                    stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        env['git_commit'] = None
+    return env
+
+
+def load_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def optional_module(name, path, notes):
+    try:
+        return load_module(name, path)
+    except (ImportError, RuntimeError) as err:
+        notes.append(f'{name} skipped: {err}')
+        print(notes[-1])
+        return None
+
+
+def timed(fn, repeat):
+    # median wall time of repeat calls and the result of the last one
+    durations = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        durations.append(time.perf_counter() - start)
+    return sorted(durations)[len(durations) // 2], result
+
+
+class Recorder:
+
+    def __init__(self):
+        self.records = []
+
+    def add(self, stage, case, metric, value):
+        self.records.append({'stage': stage, 'case': case, 'metric': metric, 'value': value})
+        print(f'{stage:<11} {case:<40} {metric:<22} {value:.4f}')
+
+
+def synthetic_files(sizes, directory, model_type, seed):
+    # one synthetic train / test pair per size
+    files = []
+    torch.manual_seed(seed)
+    # 12 time slots as in the city files, the legacy timeaware perplexity assumes them
+    truth = generate_synthetic_data.sample_globals({'G': 10, 'U': 1000, 'T': 12, 'L': 500, 'W': 2000}, model_type)
+    sampler = generate_synthetic_data.Sampler(truth, model_type, 4)
+    for size in sizes:
+        train_file = join(directory, 'train', f'synthetic-{size}.txt')
+        test_file = join(directory, 'test', f'synthetic-{size}.txt')
+        for d in [dirname(train_file), dirname(test_file)]:
+            os.makedirs(d, exist_ok=True)
+        generate_synthetic_data.generate(sampler, train_file, size, 100000)
+        generate_synthetic_data.generate(sampler, test_file, max(1, size // 4), 100000, pid_start=size)
+        files.append(train_file)
+    return files
+
+
+def test_file_of(data_file):
+    # the repo keeps test files next to the training files under test/ instead of train/
+    test_file = data_file.replace('train', 'test')
+    return test_file if test_file != data_file and os.path.exists(test_file) else data_file
+
+
+def bench_load(recorder, split, data_file, repeat):
+    ids_data = load_module(f'{split}_split_ids_data', join(SRC, 'learning', split, f'{split}_split_ids_data.py'))
+    case = os.path.basename(data_file)
+    seconds, ids = timed(lambda: ids_data.IdsData(data_file, 10), repeat)
+    recorder.add('load', case, 'read_seconds', seconds)
+    seconds, _ = timed(lambda: ids.divide_dataset(ratio=0.8), repeat)
+    recorder.add('load', case, 'divide_seconds', seconds)
+
+
+def train_script(split, data_file, model_type, steps, work_dir, memory_every=0):
+    # runs the training script with --profile in its own directory: (posterior pkl, profile summary, seconds)
+    script = join(SRC, 'learning', split, f'new_{model_type}_for_sightseeing.split_by_{split}.py')
+    run_dir = tempfile.mkdtemp(dir=work_dir)
+    os.makedirs(join(run_dir, 'pkl_model'))
+    command = [sys.executable, script, '-f', abspath(data_file), '-s', str(steps), '-t', f'split_by_{split}',
+               '--metrics-backend', '--checkpoint-every', '0',
+               '--profile', '--profile-memory-every', str(memory_every), '--profile-dir', 'profiles']
+    start = time.perf_counter()
+    completed = subprocess.run(command, cwd=run_dir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    wall = time.perf_counter() - start
+    profiles = glob(join(run_dir, 'profiles', '*.profile.json'))
+    pkls = glob(join(run_dir, 'pkl_model', '*.pkl'))
+    if completed.returncode != 0 or not profiles or not pkls:
+        print(completed.stdout.decode()[-2000:])
+        raise RuntimeError(f'training {model_type} on {data_file} failed')
+    return pkls[0], profiles[0], wall
+
+
+def bench_train(recorder, split, data_file, model_type, steps, work_dir):
+    # the training script as it is used; returns the posterior it saved
+    pkl, profile, wall = train_script(split, data_file, model_type, steps, work_dir)
+    summary = json.load(open(profile))['summary']
+    case = f'{os.path.basename(data_file)}/{model_type}'
+    # the median step leaves out the slow first steps
+    recorder.add('train', case, 'steps_per_sec', 1000. / summary['ms']['step']['median'])
+    recorder.add('train', case, 'step_ms', summary['ms']['step']['median'])
+    recorder.add('train', case, 'wall_seconds', wall)
+    return pkl
+
+
+def bench_memory(recorder, split, data_file, model_type, work_dir):
+    # a few steps with the memory of every step sampled, against the planner's estimate of the same run
+    # (group count and train ratio of the training scripts)
+    _, profile, _ = train_script(split, data_file, model_type, 3, work_dir, memory_every=1)
+    args = memory_planner.file_args(data_file, 10, 0.8)
+    estimated, peak = memory_planner.check_profile(args, model_type, profile)
+    case = f'{os.path.basename(data_file)}/{model_type}'
+    recorder.add('memory', case, 'profiled_peak_mb', peak / 2 ** 20)
+    recorder.add('memory', case, 'estimated_mb', estimated / 2 ** 20)
+    if estimated < peak:
+        raise RuntimeError(f'memory_planner estimates {memory_planner.format_size(estimated)}, '
+                           f'a profiled step peaks at {memory_planner.format_size(peak)}')
+
+
+def guarded(notes, stage, case, fn, *args):
+    # a stage failing on one case is noted, the other stages and cases still run
+    try:
+        return fn(*args)
+    except Exception as err:
+        notes.append(f'{stage} failed on {case}: {type(err).__name__}: {err}')
+        print(notes[-1])
+
+
+def bench_perplexity(recorder, perplexity, posterior, model_type, data_file, max_rows, repeat):
+    test_file = test_file_of(data_file)
+    test_data = perplexity.get_test_data(test_file, range(max_rows))
+    case = f'{os.path.basename(data_file)}/{model_type}'
+    seconds, _ = timed(lambda: perplexity.calc_score(posterior, PERPLEXITY_MODELS[model_type], test_data), repeat)
+    recorder.add('perplexity', case, 'calc_score_seconds', seconds)
+
+
+def bench_quantization(recorder, perplexity, pkl, model_type, data_file, codecs, max_rows, repeat):
+    case = f'{os.path.basename(data_file)}/{model_type}'
+    test_data = perplexity.get_test_data(test_file_of(data_file), range(max_rows)) if perplexity else None
+    original = torch.load(pkl)
+    reference = {}
+    for codec in ['float32'] + codecs:
+        path = pkl
+        if codec != 'float32':
+            path = f'{os.path.splitext(pkl)[0]}_{codec}.pkl'
+            torch.save(posterior_codec.encode_posterior(original, codec, 'compress'), path)
+        codec_case = f'{case}/{codec}'
+        recorder.add('quantization', codec_case, 'size_ratio', os.path.getsize(path) / os.path.getsize(pkl))
+        seconds, posterior = timed(lambda: posterior_bundle.load_posterior(path), repeat)
+        recorder.add('quantization', codec_case, 'load_seconds', seconds)
+        if codec != 'float32':
+            errors = [((posterior[name] - original[name].detach()).abs() / original[name].detach().abs()).max().item()
+                      for name in posterior_codec.QUANTIZED_PARAMS if name in original]
+            recorder.add('quantization', codec_case, 'max_relative_error', max(errors))
+        if perplexity is None:
+            continue
+        # the deterministic plugin estimator, so the perplexities of the codecs differ by the storage error only
+        # and not by the monte carlo noise of sampled scores
+        scores = perplexity.calc_score(posterior, PERPLEXITY_MODELS[model_type], test_data, estimator='plugin')
+        for metric, value in scores.items():
+            recorder.add('quantization', codec_case, metric, value)
+            if codec == 'float32':
+                reference[metric] = value
+            elif metric.endswith('perplexity_given_user'):
+                print(f'{"":<11} {codec_case:<40} {metric} {(value - reference[metric]) / reference[metric]:+.3%} '
+                      f'against float32')
+
+
+def bench_evaluation(recorder, evaluator, posterior, model_type, data_file, repeat):
+    test_file = test_file_of(data_file)
+    data = evaluator.divide_data_by_user(evaluator.get_test_data(test_file, None), posterior, method='loc')
+    case = f'{os.path.basename(data_file)}/{model_type}'
+    seconds, ranking = timed(lambda: evaluator.create_location_ranking(posterior, 10), repeat)
+    recorder.add('evaluation', case, 'ranking_seconds', seconds)
+    data = data[:ranking.shape[1], :ranking.shape[2]]
+    seconds, _ = timed(lambda: evaluator.evaluation_pre_and_recall(ranking, 10, data), repeat)
+    recorder.add('evaluation', case, 'pre_and_recall_seconds', seconds)
+
+
+def run(args):
+    recorder = Recorder()
+    notes = []
+    work_dir = tempfile.mkdtemp(prefix='uem-benchmark-')
+
+    files = sorted(glob(args.file)) if args.file else []
+    if args.synthetic:
+        files += synthetic_files(args.synthetic, join(work_dir, 'synthetic'), 'st', args.seed)
+    if not files:
+        print('No input files, use -f and/or --synthetic')
+        sys.exit(1)
+
+    perplexity = evaluator = None
+    if set(args.stages) & {'perplexity', 'quantization'}:
+        perplexity = optional_module('perplexity', join(SRC, 'perplexsity', f'calc_perplexity_with_pyro_{args.split}_split.py'), notes)
+    if 'evaluation' in args.stages:
+        evaluator = optional_module('evaluator', join(SRC, 'evaluation', 'evaluate_sightseeint_location_prediction.py'), notes)
+
+    for data_file in files:
+        torch.manual_seed(args.seed)
+        if 'load' in args.stages:
+            bench_load(recorder, args.split, data_file, args.repeat)
+        if not set(args.stages) & {'train', 'perplexity', 'evaluation', 'quantization', 'memory'}:
+            continue
+        for model_type in args.models:
+            case = f'{os.path.basename(data_file)}/{model_type}'
+            if 'memory' in args.stages:
+                guarded(notes, 'memory', case, bench_memory, recorder, args.split, data_file, model_type, work_dir)
+            if not set(args.stages) & {'train', 'perplexity', 'evaluation', 'quantization'}:
+                continue
+            pkl = guarded(notes, 'train', case, bench_train, recorder, args.split, data_file, model_type, args.steps,
+                          work_dir)
+            if pkl is None:
+                continue
+            posterior = torch.load(pkl)
+            if perplexity is not None and 'perplexity' in args.stages:
+                guarded(notes, 'perplexity', case, bench_perplexity, recorder, perplexity, posterior, model_type,
+                        data_file, args.max_test_rows, args.repeat)
+            if evaluator is not None:
+                guarded(notes, 'evaluation', case, bench_evaluation, recorder, evaluator, posterior, model_type,
+                        data_file, args.repeat)
+            if 'quantization' in args.stages:
+                guarded(notes, 'quantization', case, bench_quantization, recorder, perplexity, pkl, model_type,
+                        data_file, args.codecs, args.max_test_rows, args.repeat)
+
+    arguments = {k: v for k, v in vars(args).items() if k != 'func'}
+    result = {'environment': environment(), 'arguments': arguments, 'notes': notes, 'records': recorder.records}
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=1)
+    print('Benchmark saved:', args.output)
+
+
+def compare(args):
+    baseline = json.load(open(args.baseline))
+    current = json.load(open(args.current))
+    for name, env in [('baseline', baseline['environment']), ('current', current['environment'])]:
+        print(f"{name:<9} {env['host']} torch {env['torch']} threads {env['torch_threads']} commit {env['git_commit']}")
+
+    old = {(r['stage'], r['case'], r['metric']): r['value'] for r in baseline['records']}
+    regressions = 0
+    print(f"{'stage':<11} {'case':<40} {'metric':<22} {'baseline':>10} {'current':>10} {'change':>8}")
+    for r in current['records']:
+        key = (r['stage'], r['case'], r['metric'])
+        if key not in old or not old[key]:
+            continue
+        change = (r['value'] - old[key]) / old[key]
+        worse = -change if r['metric'] in HIGHER_IS_BETTER else change
+        flag = ''
+        if worse > args.threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        print(f'{r["stage"]:<11} {r["case"]:<40} {r["metric"]:<22} {old[key]:>10.4f} {r["value"]:>10.4f} '
+              f'{change:>+8.1%}{flag}')
+
+    print(f'{regressions} regression(s) above {args.threshold:.0%}')
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark of loading, training, perplexity and evaluation')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    run_parser = subparsers.add_parser('run', help='run the benchmark')
+    run_parser.add_argument('-f', '--file', default=None, type=str,
+            help='glob of id files, e.g. the 9 city files')
+    run_parser.add_argument('--synthetic', nargs='*', default=[], type=int,
+            help='also benchmark synthetic files of these numbers of rows')
+    run_parser.add_argument('--split', default='time', choices=['time', 'user'])
+    run_parser.add_argument('-m', '--models', nargs='*', default=MODELS, choices=MODELS)
+    run_parser.add_argument('--stages', nargs='*', default=['load', 'train', 'perplexity', 'evaluation'],
+            choices=['load', 'train', 'perplexity', 'evaluation', 'quantization', 'memory'])
+    run_parser.add_argument('-s', '--steps', default=50, type=int,
+            help='svi steps per training run')
+    run_parser.add_argument('--max-test-rows', default=200, type=int,
+            help='test rows scored in the perplexity stage')
+    run_parser.add_argument('--codecs', nargs='*', default=['float16', 'bfloat16', 'log-int8'],
+            choices=posterior_codec.CODECS[1:], help='codecs of the quantization stage')
+    run_parser.add_argument('--repeat', default=3, type=int,
+            help='repetitions of the load / perplexity / evaluation timings, the median is kept')
+    run_parser.add_argument('--seed', default=0, type=int)
+    run_parser.add_argument('-o', '--output', default='benchmark.json', type=str)
+    run_parser.set_defaults(func=run)
+
+    compare_parser = subparsers.add_parser('compare', help='compare a run against a baseline')
+    compare_parser.add_argument('baseline', type=str)
+    compare_parser.add_argument('current', type=str)
+    compare_parser.add_argument('--threshold', default=0.1, type=float,
+            help='relative change that counts as a regression')
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+
+    args.func(args)
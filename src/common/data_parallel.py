@@ -0,0 +1,121 @@
+# data-parallel SVI on one machine: several processes, torch.distributed with the gloo backend on localhost
+#
+# every rank holds a full replica of the param store. rows are owned round-robin by the ranks and each rank
+# subsamples its share of the mini-batch from its own rows, so per-row parameters (g_q, lambda_q) are only
+# touched by their owner and only the gradients of the global dirichlet parameters are all-reduced each step.
+
+import os
+
+import pyro
+import pyro.poutine as poutine
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from pyro.infer import SVI
+from pyro.infer.util import zero_grads
+
+import posterior_params
+
+
+def rank():
+    return dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+
+
+def world_size():
+    return dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+
+
+def barrier():
+    if world_size() > 1:
+        dist.barrier()
+
+
+def launch(fn, n_procs, port, fn_args, seed=None):
+    # runs fn(*fn_args) on n_procs ranks and waits for all of them. rank r is seeded with seed + r (a random
+    # seed when none is given): spawned processes all start from torch's default seed, and ranks drawing the
+    # same guide samples would average correlated gradient estimates instead of independent ones
+    if seed is None:
+        seed = int.from_bytes(os.urandom(4), 'little')
+    print(f'Data-parallel ranks seeded with {seed} + rank')
+    mp.spawn(_worker, args=(fn, n_procs, port, fn_args, seed), nprocs=n_procs, join=True)
+
+
+def _worker(rank, fn, n_procs, port, fn_args, seed):
+    dist.init_process_group('gloo', init_method=f'tcp://127.0.0.1:{port}', rank=rank, world_size=n_procs)
+    pyro.set_rng_seed(seed + rank)
+    # split the cores instead of every rank asking for all of them
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // n_procs))
+    try:
+        fn(*fn_args)
+    finally:
+        dist.destroy_process_group()
+
+
+def broadcast_split(ids):
+    # divide_dataset() is random, every rank has to train on the split of rank 0
+    split = [ids.training_ids, ids.test_ids]
+    dist.broadcast_object_list(split, src=0)
+    ids.training_ids, ids.test_ids = split
+
+
+def shard_args(args):
+    # rows owned by this rank and its share of the mini-batch (R / 5 unless --batch-size is given)
+    return {
+        'rows': torch.arange(rank(), args['R'], world_size()),
+        'batch_size': max(1, args.get('batch_size', int(args['R'] / 5)) // world_size()),
+    }
+
+
+def subsample_rows(args):
+    # subsample for the 'data' plate of the guide, None keeps pyro's own uniform subsampling
+    rows = args.get('rows')
+    if rows is None:
+        return None
+    return rows[torch.randperm(len(rows))[:args['batch_size']]]
+
+
+class DataParallelSVI(SVI):
+
+    def __init__(self, model, guide, optim, loss, **kwargs):
+        super().__init__(model, guide, optim, loss, **kwargs)
+        self.elbo = loss
+
+    def step(self, *args, **kwargs):
+        with poutine.trace(param_only=True) as param_capture:
+            loss = self.elbo.differentiable_loss(self.model, self.guide, *args, **kwargs)
+            loss.backward()
+
+        params = {name: site['value'].unconstrained() for name, site in param_capture.trace.nodes.items()}
+        n = world_size()
+
+        # each rank's loss is an unbiased estimate of the full ELBO, so global gradients are averaged.
+        # a row's gradient comes from its owner alone, scaled by R / (batch_size / n) instead of
+        # R / batch_size, so it is divided by n to match single process training
+        global_params = [params[name] for name in sorted(params) if name not in posterior_params.LOCAL_PARAMS]
+        flat = torch.cat([p.grad.reshape(-1) for p in global_params] + [loss.detach().reshape(1)])
+        dist.all_reduce(flat)
+        flat /= n
+        offset = 0
+        for p in global_params:
+            p.grad.copy_(flat[offset:offset + p.numel()].view_as(p))
+            offset += p.numel()
+        for name in posterior_params.LOCAL_PARAMS:
+            if name in params:
+                params[name].grad /= n
+
+        self.optim(set(params.values()))
+        zero_grads(set(params.values()))
+
+        return flat[-1].item()
+
+    def gather_local_params(self, rows):
+        # collect every rank's own rows of the per-row parameters into all replicas
+        for name in posterior_params.LOCAL_PARAMS:
+            if name not in pyro.get_param_store():
+                continue
+            unconstrained = pyro.param(name).unconstrained()
+            owned = torch.zeros_like(unconstrained)
+            owned[rows] = unconstrained.detach()[rows]
+            dist.all_reduce(owned)
+            with torch.no_grad():
+                unconstrained.copy_(owned)
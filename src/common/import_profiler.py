@@ -0,0 +1,75 @@
+# import time of the modules an entry point loads, enabled by --profile-imports on its command line
+#
+# the entry points import this module before torch / pyro, so with the flag set every later import goes
+# through a timing wrapper of builtins.__import__. at exit the report lists the top-level packages by the time
+# spent importing their own modules, and the slowest modules with their cumulative time (their imports
+# included), similar to python -X importtime but summed up per package.
+#
+#   python new_st_for_sightseeing.split_by_time.py -f <id file> --profile-imports
+
+import atexit
+import builtins
+import sys
+import time
+
+FLAG = '--profile-imports'
+TOP_MODULES = 15
+
+_original_import = builtins.__import__
+_stack = []
+# module -> [cumulative seconds, self seconds]
+timings = {}
+started = time.perf_counter()
+
+
+def _absolute(name, globals, level):
+    if not level:
+        return name
+    package = (globals or {}).get('__package__') or ''
+    if level > 1:
+        package = package.rsplit('.', level - 1)[0]
+    return f'{package}.{name}' if name else package
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    module = _absolute(name, globals, level)
+    if module in sys.modules:
+        return _original_import(name, globals, locals, fromlist, level)
+    _stack.append(0.)
+    start = time.perf_counter()
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        elapsed = time.perf_counter() - start
+        children = _stack.pop()
+        if _stack:
+            _stack[-1] += elapsed
+        timing = timings.setdefault(module, [0., 0.])
+        timing[0] += elapsed
+        timing[1] += elapsed - children
+
+
+def enable():
+    builtins.__import__ = _timed_import
+    atexit.register(report)
+
+
+def report(file=sys.stderr):
+    packages = {}
+    for module, (_, self_time) in timings.items():
+        package = module.split('.')[0]
+        packages[package] = packages.get(package, 0.) + self_time
+    total = sum(packages.values())
+
+    print(f'\nimports: {total * 1000:.0f} ms of {(time.perf_counter() - started) * 1000:.0f} ms since the profiler '
+          f'was loaded', file=file)
+    print(f'{"package":<30} {"self ms":>9} {"share":>7}', file=file)
+    for package, self_time in sorted(packages.items(), key=lambda item: -item[1])[:TOP_MODULES]:
+        print(f'{package:<30} {self_time * 1000:>9.1f} {self_time / max(total, 1e-9):>7.1%}', file=file)
+    print(f'{"module":<40} {"cumulative ms":>13} {"self ms":>9}', file=file)
+    for module, (cumulative, self_time) in sorted(timings.items(), key=lambda item: -item[1][0])[:TOP_MODULES]:
+        print(f'{module:<40} {cumulative * 1000:>13.1f} {self_time * 1000:>9.1f}', file=file)
+
+
+if FLAG in sys.argv:
+    enable()
@@ -0,0 +1,190 @@
+# memory estimate of a training run before it starts
+#
+# per step svi holds, for every variational parameter, the unconstrained tensor, its constrained value,
+# the gradient and the two Adam moments, and the guide draws one sample of every global dirichlet.
+# the peak comes from enumeration: g is enumerated over the G groups for every row of the mini-batch,
+# Categorical(pi[g]), Categorical(tau[g]) and Categorical(phi[g]) broadcast their probabilities to
+# (G, 1, batch, U / T / L) and the tag distribution to (G, lenW, batch, W) when their log-probabilities are
+# taken. the s / t / st models additionally build their tag mixture as (G, batch, W) tensors.
+# the copies of each are calibrated against the per-step peak of step_profiler (--profile), see check_profile().
+#
+#   python memory_planner.py -f <id file> -m st -g 10 --budget 8G
+#   python memory_planner.py -f <id file> -m st -r 0.8 --check-profile ./profiles/<key>.profile.json
+
+import argparse
+import csv
+import json
+import sys
+
+import posterior_params
+
+BYTES = 4  # float32
+# copies of each param tensor: unconstrained value, constrained value, gradient, two Adam moments
+PARAM_COPIES = {'params': 2, 'gradients': 1, 'adam': 2}
+# global samples of the guide, their log densities' intermediates and gradients
+SAMPLE_COPIES = 3
+# (G, 1, batch, U + T + L) tensors per step: the broadcast probabilities of the observed user, time and
+# location, their logs and the gradients of both
+VOCAB_COPIES = 4
+# (G, lenW, batch, W) tensors per step: the broadcast log-probabilities of the tags, forward and backward
+TAG_COPIES = 4
+# (G, batch, W) tensors of the tag mixture per step
+MIXTURE_COPIES = {'base': 0, 's': 4, 't': 3, 'st': 4}
+# the remaining enumerated tensors are (G, batch) or (G, lenW, batch), a few per observed site
+SITE_COPIES = 8
+UNITS = {'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30, 'T': 2 ** 40}
+
+
+def parse_size(size):
+    # '8G', '512M', '1.5G' or a plain number of bytes
+    size = str(size).strip().upper().rstrip('B')
+    if size and size[-1] in UNITS:
+        return int(float(size[:-1]) * UNITS[size[-1]])
+    return int(float(size))
+
+
+def format_size(n_bytes):
+    for unit in ['T', 'G', 'M', 'K']:
+        if n_bytes >= UNITS[unit]:
+            return f'{n_bytes / UNITS[unit]:.2f} {unit}B'
+    return f'{n_bytes} B'
+
+
+def default_batch_size(args):
+    return args.get('batch_size', int(args['R'] / 5))
+
+
+def estimate(args, model_type, batch_size=None):
+    # bytes per component for vi_args (G, U, T, L, W, R, lenW, and C for multi-city runs)
+    batch = batch_size or default_batch_size(args)
+    shapes = posterior_params.param_shapes(args, model_type)
+    n_local = 0
+    n_global = 0
+    for name, shape in shapes.items():
+        n = 1
+        for size in shape:
+            n *= size
+        if name in posterior_params.LOCAL_PARAMS:
+            n_local += n
+        else:
+            # multi-city runs keep one padded copy of the globals per city
+            n_global += n * args.get('C', 1)
+
+    n_params = n_local + n_global
+    sizes = {name: copies * n_params * BYTES for name, copies in PARAM_COPIES.items()}
+    sizes['samples'] = SAMPLE_COPIES * n_global * BYTES
+    sizes['enumeration'] = (args['G'] * batch * args['W'] * (TAG_COPIES * args['lenW'] + MIXTURE_COPIES[model_type])
+                            + VOCAB_COPIES * args['G'] * batch * (args['U'] + args['T'] + args['L'])
+                            + SITE_COPIES * args['G'] * batch * (args['lenW'] + 4)) * BYTES
+    sizes['total'] = sum(sizes.values())
+    return sizes
+
+
+def max_batch_size(args, model_type, budget):
+    # largest mini-batch whose estimate fits into budget bytes, 0 if not even one row fits
+    one_row = estimate(args, model_type, 1)
+    per_row = one_row['enumeration']
+    fixed = one_row['total'] - per_row
+    if fixed + per_row > budget:
+        return 0
+    return min(args['R'], int((budget - fixed) // per_row))
+
+
+def check_budget(args, model_type, budget, auto_batch=False):
+    # batch size to train with under budget bytes; raises if it does not fit and may not be shrunk
+    batch = default_batch_size(args)
+    needed = estimate(args, model_type, batch)['total']
+    if needed <= budget:
+        return batch
+
+    fitting = max_batch_size(args, model_type, budget)
+    if not auto_batch or fitting == 0:
+        raise ValueError(f'{model_type} needs about {format_size(needed)} with batch size {batch}, '
+                         f'budget is {format_size(budget)}'
+                         + (f' (batch size {fitting} would fit, see --auto-batch)' if fitting else ''))
+    print(f'Batch size {batch} needs about {format_size(needed)}, '
+          f'using {fitting} to stay within {format_size(budget)}')
+    return fitting
+
+
+def file_args(filename, group_count, train_ratio=1.):
+    # vi_args of a training run on an id file, without building the tensors
+    u = t = l = w = rows = 0
+    len_w = 0
+    with open(filename) as f:
+        for row in csv.reader(f):
+            tags = [int(tag) for tag in row[4].split(',')]
+            u = max(u, int(row[1]))
+            t = max(t, int(row[2]))
+            l = max(l, int(row[3]))
+            w = max(w, max(tags))
+            len_w = len(tags)
+            rows += 1
+    return {'G': group_count, 'U': u + 1, 'T': t + 1, 'L': l + 1, 'W': w + 1,
+            'R': int(rows * train_ratio), 'lenW': len_w}
+
+
+def check_profile(args, model_type, profile_file):
+    # (estimated bytes, per-step peak bytes) of a training run profiled with --profile; the estimate should not
+    # be below the peak
+    with open(profile_file) as f:
+        summary = json.load(f)['summary']
+    if not summary['memory_steps']:
+        raise ValueError(f'{profile_file} has no memory samples, profile with --profile-memory-every > 0')
+    return estimate(args, model_type)['total'], int(summary['peak_mb'] * UNITS['M'])
+
+
+def format_estimate(estimate):
+    return '  '.join(f'{name} {format_size(n)}' for name, n in estimate.items())
+
+
+def main(args):
+    vi_args = file_args(args.file, args.groups, args.train_ratio)
+    if args.batch_size:
+        vi_args['batch_size'] = args.batch_size
+    print(vi_args)
+
+    if args.check_profile:
+        if len(args.models) != 1:
+            sys.exit('--check-profile needs the model of the profiled run, one -m')
+        estimated, peak = check_profile(vi_args, args.models[0], args.check_profile)
+        print(f'{args.models[0]}: estimate {format_size(estimated)}, profiled peak {format_size(peak)} '
+              f'({estimated / peak:.2f}x)')
+        if estimated < peak:
+            sys.exit(1)
+        return
+
+    fits = True
+    for model_type in args.models:
+        e = estimate(vi_args, model_type)
+        print(f'{model_type:<5}', format_estimate(e))
+        if args.budget:
+            budget = parse_size(args.budget)
+            fitting = max_batch_size(vi_args, model_type, budget)
+            print(f'      budget {format_size(budget)}: {"fits" if e["total"] <= budget else "does not fit"}, '
+                  f'largest batch size {fitting}')
+            fits = fits and e['total'] <= budget
+    if not fits:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='memory estimate of a training run')
+    parser.add_argument('-f', '--file', required=True, type=str,
+            help='id file to train on')
+    parser.add_argument('-m', '--models', nargs='*', default=['base', 's', 't', 'st'],
+            choices=['base', 's', 't', 'st'])
+    parser.add_argument('-g', '--groups', default=10, type=int,
+            help='number of groups G')
+    parser.add_argument('-r', '--train-ratio', default=1., type=float)
+    parser.add_argument('--batch-size', default=None, type=int,
+            help='mini-batch size (default: R / 5 as in training)')
+    parser.add_argument('--budget', default=None, type=str,
+            help='memory budget, e.g. 8G; exits with 1 if a model does not fit')
+    parser.add_argument('--check-profile', default=None, type=str,
+            help='<key>.profile.json of a run of the model with --profile; exits with 1 if the estimate is below '
+                 'its per-step peak')
+
+    args = parser.parse_args()
+
+    main(args)
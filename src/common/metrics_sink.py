@@ -0,0 +1,208 @@
+# buffered metrics for the training scripts
+#
+# MetricsSink has the parts of the comet Experiment the scripts use (log_metric, log_parameters, add_tags,
+# train(), get_key(), end()), but log_metric() only appends to an in-memory buffer. a background thread
+# hands the buffer to the backends in batches, so a slow or unreachable tracker never blocks svi.step().
+#
+# backends:
+#   jsonl   one json record per line in <metrics-dir>/<key>.jsonl
+#   sqlite  tables metrics / parameters / tags / others in <metrics-dir>/metrics.sqlite
+#   comet   comet.ml experiment, key from COMET_API_KEY / COMET_WORKSPACE / COMET_PROJECT (or ~/.comet.config)
+
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+BACKENDS = ['jsonl', 'sqlite', 'comet']
+
+
+class JsonlBackend:
+
+    def __init__(self, directory, key):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.path = os.path.join(directory, key + '.jsonl')
+        self.f = open(self.path, 'a')
+
+    def write(self, records):
+        for record in records:
+            self.f.write(json.dumps(record) + '\n')
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class SqliteBackend:
+
+    def __init__(self, directory, key):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.path = os.path.join(directory, 'metrics.sqlite')
+        self.key = key
+        # written from the flush thread only
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.executescript('''
+            create table if not exists metrics (experiment text, context text, name text, step integer,
+                                                value real, time real);
+            create table if not exists parameters (experiment text, name text, value text);
+            create table if not exists tags (experiment text, tag text);
+            create table if not exists others (experiment text, name text, value text);
+        ''')
+
+    def write(self, records):
+        metrics = []
+        parameters = []
+        tags = []
+        others = []
+        for r in records:
+            if r['type'] == 'metric':
+                metrics.append((self.key, r['context'], r['name'], r['step'], r['value'], r['time']))
+            elif r['type'] == 'parameters':
+                parameters.extend((self.key, name, json.dumps(value)) for name, value in r['value'].items())
+            elif r['type'] == 'tags':
+                tags.extend((self.key, tag) for tag in r['value'])
+            else:
+                others.append((self.key, r['name'], json.dumps(r['value'])))
+        with self.db:
+            self.db.executemany('insert into metrics values (?, ?, ?, ?, ?, ?)', metrics)
+            self.db.executemany('insert into parameters values (?, ?, ?)', parameters)
+            self.db.executemany('insert into tags values (?, ?)', tags)
+            self.db.executemany('insert into others values (?, ?, ?)', others)
+
+    def close(self):
+        self.db.close()
+
+
+class CometBackend:
+
+    def __init__(self, debug=False):
+        # comet is only needed when it is asked for
+        from comet_ml import Experiment
+
+        self.experiment = Experiment(
+                api_key=os.environ.get('COMET_API_KEY'),
+                project_name='test' if debug else os.environ.get('COMET_PROJECT', 'uem-training'),
+                workspace=os.environ.get('COMET_WORKSPACE'),
+                auto_output_logging='simple')
+
+    def get_key(self):
+        return self.experiment.get_key()
+
+    def write(self, records):
+        for r in records:
+            if r['type'] == 'metric':
+                if r['context'] == 'train':
+                    with self.experiment.train():
+                        self.experiment.log_metric(r['name'], r['value'], step=r['step'])
+                else:
+                    self.experiment.log_metric(r['name'], r['value'], step=r['step'])
+            elif r['type'] == 'parameters':
+                self.experiment.log_parameters(r['value'])
+            elif r['type'] == 'tags':
+                self.experiment.add_tags(r['value'])
+            elif r['name'] == 'dataset':
+                self.experiment.log_dataset_info(path=r['value'])
+            else:
+                self.experiment.log_other(r['name'], r['value'])
+
+    def close(self):
+        self.experiment.end()
+
+
+class MetricsSink:
+
+    def __init__(self, backends, flush_interval=5.0, key=None):
+        self.backends = backends
+        self.flush_interval = flush_interval
+        self.key = key or uuid.uuid4().hex
+        self.context = None
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        if backends:
+            self.thread = threading.Thread(target=self._flush_loop, daemon=True)
+            self.thread.start()
+
+    def get_key(self):
+        return self.key
+
+    def _append(self, record):
+        if not self.backends:
+            return
+        with self.lock:
+            self.buffer.append(record)
+
+    def log_metric(self, name, value, step=None):
+        self._append({'type': 'metric', 'context': self.context, 'name': name, 'step': step,
+                      'value': float(value), 'time': time.time()})
+
+    def log_parameters(self, parameters):
+        # values that json can not store are kept as their repr
+        self._append({'type': 'parameters', 'value': json.loads(json.dumps(parameters, default=repr))})
+
+    def add_tags(self, tags):
+        self._append({'type': 'tags', 'value': list(tags)})
+
+    def log_other(self, name, value):
+        self._append({'type': 'other', 'name': name, 'value': value})
+
+    def log_dataset_info(self, path):
+        self.log_other('dataset', path)
+
+    def set_cmd_args(self):
+        self.log_other('command', ' '.join(sys.argv))
+
+    @contextmanager
+    def train(self):
+        self.context = 'train'
+        try:
+            yield self
+        finally:
+            self.context = None
+
+    def flush(self):
+        with self.lock:
+            records, self.buffer = self.buffer, []
+        if not records:
+            return
+        for backend in self.backends:
+            try:
+                backend.write(records)
+            except Exception as err:
+                # a broken tracker must not stop the training
+                print(f'{type(backend).__name__}: could not write {len(records)} records: {err}')
+
+    def _flush_loop(self):
+        while not self.stopped.wait(self.flush_interval):
+            self.flush()
+
+    def end(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
+        for backend in self.backends:
+            backend.close()
+        self.backends = []
+
+
+def create_sink(names, directory='./metrics', debug=False):
+    # the comet key names the pkl files when comet is used, so runs can still be looked up there
+    backends = []
+    key = uuid.uuid4().hex
+    if 'comet' in names:
+        backends.append(CometBackend(debug))
+        key = backends[0].get_key()
+    for name in names:
+        if name == 'jsonl':
+            backends.append(JsonlBackend(directory, key))
+        elif name == 'sqlite':
+            backends.append(SqliteBackend(directory, key))
+    return MetricsSink(backends, key=key)
@@ -0,0 +1,88 @@
+# several cities in one model: the training sets are concatenated and every row remembers its city,
+# the vocabularies (users, times, locations, tags) are padded to the largest city
+#
+# a dirichlet restricted to a subset of its entries and renormalised is the dirichlet of that subset,
+# so masking the padded entries out of every distribution leaves each city's own model unchanged
+
+import torch
+
+import posterior_params
+
+# vocabulary along each axis of a single-city concentration, None for axes that are not padded
+PADDED_AXES = {
+    'alpha_q': (None,),
+    'gamma_q': (None, 'U'),
+    'kappa_q': (None, 'T'),
+    'beta_q': (None, 'L'),
+    'delta_q': (None, 'W'),
+    'zeta_q': ('L', None),
+    'epsilon_q': ('L', 'W'),
+    'iota_q': ('T', 'W'),
+}
+
+
+def stack_cities(ids_list):
+    # training sets of several IdsData (already divided) as one padded data set
+    parts = [ids.get_training_set() for ids in ids_list]
+    city_args = [args for _, args in parts]
+    for key in ['G', 'lenW']:
+        if len(set(args[key] for args in city_args)) > 1:
+            raise ValueError(f'all cities need the same {key}: {[args[key] for args in city_args]}')
+
+    args = {
+        'C': len(parts),
+        'G': city_args[0]['G'],
+        'lenW': city_args[0]['lenW'],
+        'R': sum(args['R'] for args in city_args),
+    }
+    for key in ['U', 'T', 'L', 'W']:
+        args[key] = max(a[key] for a in city_args)
+
+    data = {
+        'u': torch.cat([d['u'] for d, _ in parts]),
+        't': torch.cat([d['t'] for d, _ in parts]),
+        'l': torch.cat([d['l'] for d, _ in parts]),
+        'tag': torch.cat([d['tag'] for d, _ in parts], 1),
+        'city': torch.cat([torch.full((a['R'],), c, dtype=torch.long) for c, a in enumerate(city_args)]),
+    }
+    for key in ['U', 'T', 'L', 'W']:
+        data[key.lower() + '_mask'] = torch.stack(
+            [(torch.arange(args[key]) < a[key]).float() for a in city_args])
+
+    return data, args, city_args
+
+
+def restrict(probs, mask):
+    # renormalise probability vectors over the entries a city actually has
+    probs = probs * mask
+    return probs / probs.sum(-1, keepdim=True)
+
+
+def city_rows(city_args):
+    # rows of every city in the concatenated data set
+    rows = []
+    start = 0
+    for args in city_args:
+        rows.append(slice(start, start + args['R']))
+        start += args['R']
+    return rows
+
+
+def city_posterior(params, c, city_args, model_type=None):
+    # the posterior of city c in the format of a single-city run
+    args = city_args[c]
+    rows = city_rows(city_args)[c]
+    model_type = model_type or posterior_params.infer_model_type(params)
+    posterior = {}
+    for name, value in params.items():
+        value = value.detach()
+        if name in posterior_params.LOCAL_PARAMS:
+            posterior[name] = value[rows]
+            continue
+        block = tuple(slice(None) if key is None else slice(0, args[key]) for key in PADDED_AXES[name])
+        if name == 'zeta_q' and model_type == 't':
+            # the t model indexes the location-sized zeta by time, a city with fewer locations than time slots
+            # keeps the rows of all its time slots
+            block = (slice(0, max(args['L'], args['T'])), slice(None))
+        posterior[name] = value[c][block].clone()
+    return posterior
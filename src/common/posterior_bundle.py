@@ -0,0 +1,206 @@
+# posterior bundle: a directory with a json header and one .npy file per parameter
+#
+#   <key>.bundle/header.json        data_file, tags, model type and the shape / dtype / file of every array
+#   <key>.bundle/global/<name>.npy  dirichlet concentrations (alpha_q, gamma_q, ...)
+#   <key>.bundle/local/<name>.npy   per-row parameters (g_q, lambda_q), optional
+#   <key>.bundle/summary/<name>.npy posterior means and expected logs (theta_mean, phi_expected_log, ...)
+#   <key>.bundle/meta/test_ids.npy
+#
+# PosteriorBundle reads like the dict of a posterior pkl, but an array is only memory-mapped when it is
+# looked up, so a reader that needs a few G x L matrices never reads g_q.
+#
+#   python posterior_bundle.py ./pkl_bkp/*.pkl --no-locals    converts existing pkls
+#   python posterior_bundle.py ./pkl_bkp/*.pkl --format pkl --quantize log-int8 --compress-locals
+#                                                             compact pkls, see posterior_codec.py
+
+import argparse
+import json
+import os
+import shutil
+from collections.abc import Mapping
+
+import numpy as np
+import torch
+
+import posterior_codec
+import posterior_params
+
+FORMAT = 'uem-posterior-bundle'
+VERSION = 1
+HEADER = 'header.json'
+
+
+def is_bundle(path):
+    return os.path.isfile(os.path.join(path, HEADER))
+
+
+def _kind(name):
+    if name in posterior_params.LOCAL_PARAMS:
+        return 'local'
+    if name in posterior_params.GLOBAL_PARAMS.values():
+        return 'global'
+    if posterior_params.is_summary(name):
+        return 'summary'
+    return 'meta'
+
+
+def _write_encoded(path, kind, name, record):
+    # the parts of a posterior_codec record: stored data (or its zlib chunks), per-row offsets and scales
+    info = {'kind': kind, 'shape': record['shape'], 'dtype': 'float32', 'codec': record['codec']}
+    if 'chunks' in record:
+        info['file'] = os.path.join(kind, name + '.zchunks')
+        info['stored_dtype'] = record['dtype']
+        info['chunk_rows'] = record['chunk_rows']
+        info['chunk_bytes'] = [len(chunk) for chunk in record['chunks']]
+        with open(os.path.join(path, info['file']), 'wb') as f:
+            for chunk in record['chunks']:
+                f.write(chunk)
+    else:
+        info['file'] = os.path.join(kind, name + '.npy')
+        np.save(os.path.join(path, info['file']), record['data'].numpy())
+    for part in ['offset', 'scale']:
+        if part in record:
+            info[part + '_file'] = os.path.join(kind, f'{name}.{part}.npy')
+            np.save(os.path.join(path, info[part + '_file']), record[part].numpy())
+    return info
+
+
+def _read_encoded(path, info):
+    record = {'codec': info['codec'], 'shape': info['shape']}
+    if 'chunk_bytes' in info:
+        record['dtype'] = info['stored_dtype']
+        record['chunks'] = []
+        with open(os.path.join(path, info['file']), 'rb') as f:
+            for n_bytes in info['chunk_bytes']:
+                record['chunks'].append(f.read(n_bytes))
+    else:
+        record['data'] = np.load(os.path.join(path, info['file']), mmap_mode='r')
+    for part in ['offset', 'scale']:
+        if part + '_file' in info:
+            record[part] = np.load(os.path.join(path, info[part + '_file']))
+    return record
+
+
+def write_bundle(path, posterior, include_locals=True):
+    # arrays are written first and the header last, a bundle without header is incomplete
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    header = {'format': FORMAT, 'version': VERSION, 'arrays': {}, 'values': {}}
+    for name, value in posterior.items():
+        if isinstance(value, torch.Tensor):
+            kind = _kind(name)
+            if kind == 'local' and not include_locals:
+                continue
+            array = value.detach().cpu().numpy()
+            relative = os.path.join(kind, name + '.npy')
+            os.makedirs(os.path.join(tmp_path, kind), exist_ok=True)
+            np.save(os.path.join(tmp_path, relative), array)
+            header['arrays'][name] = {'file': relative, 'kind': kind, 'shape': list(array.shape),
+                                      'dtype': str(array.dtype)}
+        elif posterior_codec.is_encoded(value):
+            kind = _kind(name)
+            if kind == 'local' and not include_locals:
+                continue
+            os.makedirs(os.path.join(tmp_path, kind), exist_ok=True)
+            header['arrays'][name] = _write_encoded(tmp_path, kind, name, value)
+        else:
+            header['values'][name] = value
+    header['model_type'] = posterior_params.infer_model_type(posterior)
+
+    os.makedirs(tmp_path, exist_ok=True)
+    with open(os.path.join(tmp_path, HEADER), 'w') as f:
+        json.dump(header, f, indent=1)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+
+
+class PosteriorBundle(Mapping):
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, HEADER)) as f:
+            self.header = json.load(f)
+        if self.header.get('format') != FORMAT:
+            raise ValueError(f'{path} is not a posterior bundle')
+        self.loaded = {}
+
+    def __getitem__(self, name):
+        if name in self.header['values']:
+            return self.header['values'][name]
+        if name not in self.header['arrays']:
+            raise KeyError(name)
+        if name not in self.loaded and 'codec' in self.header['arrays'][name]:
+            # stored in compact form, decoded to float32 on first lookup
+            self.loaded[name] = posterior_codec.decode(_read_encoded(self.path, self.header['arrays'][name]))
+        if name not in self.loaded:
+            # copy-on-write mapping: pages are read on first touch and callers may modify their copy
+            array = np.load(os.path.join(self.path, self.header['arrays'][name]['file']), mmap_mode='c')
+            self.loaded[name] = torch.from_numpy(array)
+        return self.loaded[name]
+
+    def __iter__(self):
+        yield from self.header['arrays']
+        yield from self.header['values']
+
+    def __len__(self):
+        return len(self.header['arrays']) + len(self.header['values'])
+
+    def names(self, kind):
+        # array names of one kind: 'global', 'local', 'summary' or 'meta'
+        return [name for name, info in self.header['arrays'].items() if info['kind'] == kind]
+
+    def to_dict(self):
+        return {name: self[name] for name in self}
+
+
+def load_posterior(path):
+    # a posterior pkl or bundle; pkls are loaded whole, bundles lazily, compact parameters come back as float32
+    if is_bundle(path):
+        return PosteriorBundle(path)
+    return posterior_codec.decode_posterior(torch.load(path))
+
+
+def save_posterior(path, posterior):
+    if path.endswith('.bundle'):
+        write_bundle(path, posterior)
+    else:
+        torch.save(posterior, path)
+
+
+def _size(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def main(args):
+    locals_mode = 'drop' if args.no_locals else 'compress' if args.compress_locals else 'keep'
+    for filename in args.files:
+        posterior = posterior_codec.encode_posterior(load_posterior(filename), args.quantize, locals_mode)
+        stem = os.path.splitext(filename)[0]
+        if args.format == 'bundle':
+            output = stem + '.bundle'
+            write_bundle(output, posterior)
+        else:
+            output = stem + '_compact.pkl'
+            torch.save(posterior, output)
+        print(f'{filename} ({_size(filename)} bytes) -> {output} ({_size(output)} bytes)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='convert posterior pkls to bundles or compact pkls')
+    parser.add_argument('files', nargs='+', type=str)
+    parser.add_argument('--format', default='bundle', choices=['bundle', 'pkl'],
+            help='bundle: <stem>.bundle, pkl: <stem>_compact.pkl')
+    parser.add_argument('--quantize', default=None, choices=posterior_codec.CODECS,
+            help=f'store {", ".join(posterior_codec.QUANTIZED_PARAMS)} in this precision')
+    parser.add_argument('--no-locals', action='store_true',
+            help='leave out the per-row parameters (g_q, lambda_q)')
+    parser.add_argument('--compress-locals', action='store_true',
+            help='store the per-row parameters as zlib chunks')
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,122 @@
+# compact storage of a posterior: the large matrices in float16 / bfloat16 or log-quantized int8, and the
+# per-row parameters dropped or compressed in chunks of rows
+#
+# an encoded parameter is a dict with a 'codec' key in place of its tensor. posterior_bundle.load_posterior()
+# decodes pkls and bundles, so readers always get float32 tensors back.
+#
+#   log-int8   log(x) of every row (last dimension) mapped linearly onto -127..127 with the row's min / step,
+#              relative error at most exp(step / 2) - 1
+#   float16    half precision, concentrations above 65504 are clipped and those below 6e-5 lose digits
+#   bfloat16   the upper 16 bits of float32, rounded to nearest; keeps the range, ~3 significant digits
+#
+# log-int8 stores a float32 offset and step per row, so it only beats the 16 bit codecs on long rows
+# (gamma_q, epsilon_q, iota_q), not on g_q with its G columns.
+
+import zlib
+
+import numpy as np
+import torch
+
+import posterior_params
+
+# the matrices that dominate the size of a posterior
+QUANTIZED_PARAMS = ['g_q', 'epsilon_q', 'iota_q', 'gamma_q']
+CODECS = ['float32', 'float16', 'bfloat16', 'log-int8']
+LOCALS = ['keep', 'drop', 'compress']
+FLOAT16_MAX = 65504.
+TINY = 1e-30
+
+
+def is_encoded(value):
+    return isinstance(value, dict) and 'codec' in value
+
+
+def _rows(array):
+    return array.reshape(-1, array.shape[-1]) if array.ndim > 1 else array.reshape(1, -1)
+
+
+def encode(value, codec):
+    array = value.detach().cpu().float().numpy()
+    record = {'codec': codec, 'shape': list(array.shape)}
+    if codec == 'float32':
+        record['data'] = array
+    elif codec == 'float16':
+        record['data'] = np.clip(array, -FLOAT16_MAX, FLOAT16_MAX).astype(np.float16)
+    elif codec == 'bfloat16':
+        bits = array.view(np.uint32).astype(np.uint64)
+        rounded = (bits + 0x7FFF + ((bits >> 16) & 1)) >> 16
+        record['data'] = rounded.astype(np.uint16).view(np.int16)
+    elif codec == 'log-int8':
+        log = np.log(np.maximum(_rows(array), TINY))
+        offset = log.min(1, keepdims=True)
+        scale = np.maximum(log.max(1, keepdims=True) - offset, 1e-12) / 254.
+        record['data'] = (np.rint((log - offset) / scale) - 127).astype(np.int8).reshape(array.shape)
+        record['offset'] = offset.astype(np.float32)
+        record['scale'] = scale.astype(np.float32)
+    else:
+        raise ValueError(f'unknown codec {codec}, one of {CODECS}')
+    record['data'] = torch.from_numpy(record['data'])
+    for key in ['offset', 'scale']:
+        if key in record:
+            record[key] = torch.from_numpy(record[key])
+    return record
+
+
+def compress(record, chunk_rows=65536):
+    # zlib chunks of chunk_rows rows each, so a reader can stop after the rows it needs
+    data = record.pop('data').numpy()
+    record['dtype'] = str(data.dtype)
+    record['chunk_rows'] = chunk_rows
+    record['chunks'] = [zlib.compress(data[start:start + chunk_rows].tobytes())
+                        for start in range(0, len(data), chunk_rows)]
+    return record
+
+
+def decode(record):
+    if 'chunks' in record:
+        row_shape = record['shape'][1:]
+        data = np.concatenate([np.frombuffer(zlib.decompress(chunk), dtype=record['dtype']).reshape([-1] + row_shape)
+                               for chunk in record['chunks']])
+    else:
+        data = np.asarray(record['data'])
+    codec = record['codec']
+    if codec in ['float32', 'float16']:
+        array = data.astype(np.float32)
+    elif codec == 'bfloat16':
+        array = (data.view(np.uint16).astype(np.uint32) << 16).view(np.float32)
+    elif codec == 'log-int8':
+        offset = np.asarray(record['offset'])
+        scale = np.asarray(record['scale'])
+        array = np.exp(offset + (_rows(data).astype(np.float32) + 127) * scale).astype(np.float32)
+    else:
+        raise ValueError(f'unknown codec {codec}, one of {CODECS}')
+    return torch.from_numpy(np.ascontiguousarray(array).reshape(record['shape']))
+
+
+def encode_posterior(posterior, codec=None, locals_mode='keep', chunk_rows=65536):
+    # copy of posterior with QUANTIZED_PARAMS encoded with codec and the per-row parameters kept, dropped or
+    # compressed; summaries of quantized concentrations are left out, posterior_params.summary() recomputes them
+    quantized = [name for name in QUANTIZED_PARAMS if codec and codec != 'float32']
+    skipped = [latent + '_' + kind for latent, name in posterior_params.GLOBAL_PARAMS.items() if name in quantized
+               for kind in posterior_params.SUMMARY_KINDS]
+    encoded = {}
+    for name, value in posterior.items():
+        if name in skipped:
+            continue
+        if name in posterior_params.LOCAL_PARAMS:
+            if locals_mode == 'drop':
+                continue
+            if locals_mode == 'compress':
+                encoded[name] = compress(encode(value, codec if name in quantized else 'float32'), chunk_rows)
+                continue
+        if name in quantized and isinstance(value, torch.Tensor):
+            encoded[name] = encode(value, codec)
+        else:
+            encoded[name] = value
+    return encoded
+
+
+def decode_posterior(posterior):
+    if not any(is_encoded(value) for value in posterior.values()):
+        return posterior
+    return {name: decode(value) if is_encoded(value) else value for name, value in posterior.items()}
@@ -0,0 +1,147 @@
+# structure of the variational parameters shared by the base / s / t / st guides
+# and closed-form expectations under their mean-field Dirichlet posteriors
+
+import torch
+
+# latent variable -> dirichlet concentration in the guide
+GLOBAL_PARAMS = {
+    'theta': 'alpha_q',
+    'pi': 'gamma_q',
+    'tau': 'kappa_q',
+    'phi': 'beta_q',
+    'sigma': 'delta_q',
+    'eta': 'zeta_q',
+    'mu': 'epsilon_q',
+    'rho': 'iota_q',
+}
+
+# per-row parameters, one row per training photo
+LOCAL_PARAMS = ['g_q', 'lambda_q']
+
+# closed-form summaries saved next to the concentrations, '<latent>_mean' and '<latent>_expected_log'
+SUMMARY_KINDS = ['mean', 'expected_log']
+
+# where a tag is drawn from, in the order of the lambda components of each model
+SWITCH_SOURCES = {
+    'base': ['group'],
+    's': ['location', 'group'],
+    't': ['time', 'group'],
+    'st': ['location', 'time', 'group'],
+}
+
+# tag distribution of each non-group source
+SOURCE_PARAMS = {'location': 'epsilon_q', 'time': 'iota_q'}
+
+
+def source_params(model_type):
+    # the location / time tag distributions a model draws tags from. the s guide also declares an iota_q, but the
+    # model never uses rho, so it stays at its initial value and carries nothing to warm-start from
+    return [SOURCE_PARAMS[source] for source in SWITCH_SOURCES[model_type] if source in SOURCE_PARAMS]
+
+
+def infer_model_type(posterior):
+    # the s guide also carries an (unused) iota_q, so tell the models apart by the lambda components
+    if 'zeta_q' not in posterior:
+        return 'base'
+    if posterior['zeta_q'].shape[-1] == 3:
+        return 'st'
+    return 's' if 'epsilon_q' in posterior else 't'
+
+
+def param_shapes(args, model_type):
+    G, U, T, L, W, R = (args[k] for k in ['G', 'U', 'T', 'L', 'W', 'R'])
+    shapes = {
+        'alpha_q': (G,),
+        'gamma_q': (G, U),
+        'kappa_q': (G, T),
+        'beta_q': (G, L),
+        'delta_q': (G, W),
+        'g_q': (R, G),
+    }
+    if model_type in ['s', 'st']:
+        shapes['epsilon_q'] = (L, W)
+    if model_type in ['s', 't', 'st']:
+        # declared by the s guide too, see source_params()
+        shapes['iota_q'] = (T, W)
+    if model_type != 'base':
+        # zeta lives on the location plate in every model, the t model indexes it by time
+        shapes['zeta_q'] = (L, len(SWITCH_SOURCES[model_type]))
+        shapes['lambda_q'] = (R, len(SWITCH_SOURCES[model_type]))
+    return shapes
+
+
+def dirichlet_mean(concentration):
+    return concentration / concentration.sum(-1, keepdim=True)
+
+
+def dirichlet_expected_log(concentration):
+    return torch.digamma(concentration) - torch.digamma(concentration.sum(-1, keepdim=True))
+
+
+def log_expectations(posterior, expected_log=True):
+    # E[log x] of every global dirichlet, or log E[x] for plug-in estimates
+    log_e = {}
+    for latent, name in GLOBAL_PARAMS.items():
+        if name not in posterior:
+            continue
+        if expected_log:
+            log_e[latent] = summary(posterior, latent, 'expected_log')
+        else:
+            log_e[latent] = torch.log(summary(posterior, latent, 'mean'))
+    return log_e
+
+
+def summaries(posterior):
+    # E[x] and E[log x] of every global dirichlet, keyed '<latent>_<kind>'
+    result = {}
+    for latent, name in GLOBAL_PARAMS.items():
+        if name not in posterior:
+            continue
+        concentration = posterior[name].detach()
+        result[latent + '_mean'] = dirichlet_mean(concentration)
+        result[latent + '_expected_log'] = dirichlet_expected_log(concentration)
+    return result
+
+
+def is_summary(name):
+    return any(name.endswith('_' + kind) and name[:-len(kind) - 1] in GLOBAL_PARAMS for kind in SUMMARY_KINDS)
+
+
+def summary(posterior, latent, kind='mean'):
+    # a stored summary, computed from the concentration for posteriors saved without them
+    key = latent + '_' + kind
+    if key in posterior:
+        return posterior[key]
+    concentration = posterior[GLOBAL_PARAMS[latent]].detach()
+    return dirichlet_mean(concentration) if kind == 'mean' else dirichlet_expected_log(concentration)
+
+
+def row_log_joint(log_e, data, model_type):
+    # unnormalised log q(g, c) of every row: (R, G, number of tag sources)
+    # data as returned by IdsData.get_training_set(), tag is (lenW, R)
+    u, t, l, tags = data['u'], data['t'], data['l'], data['tag']
+
+    log_g = log_e['theta'].unsqueeze(0) + log_e['pi'][:, u].T + log_e['tau'][:, t].T + log_e['phi'][:, l].T
+    switch_index = t if model_type == 't' else l
+
+    columns = []
+    for c, source in enumerate(SWITCH_SOURCES[model_type]):
+        if source == 'group':
+            emission = log_e['sigma'][:, tags].sum(1).T
+        elif source == 'location':
+            emission = log_e['mu'][l.unsqueeze(0), tags].sum(0).unsqueeze(1)
+        else:
+            emission = log_e['rho'][t.unsqueeze(0), tags].sum(0).unsqueeze(1)
+        if model_type != 'base':
+            emission = emission + log_e['eta'][switch_index, c].unsqueeze(1)
+        columns.append(log_g + emission)
+
+    return torch.stack(columns, 2)
+
+
+def row_responsibilities(posterior, data, model_type=None, expected_log=True):
+    # q(g) (R, G) and q(c) (R, number of tag sources) given the global parameters
+    model_type = model_type or infer_model_type(posterior)
+    log_joint = row_log_joint(log_expectations(posterior, expected_log), data, model_type)
+    q = torch.softmax(log_joint.reshape(len(log_joint), -1), 1).reshape(log_joint.shape)
+    return q.sum(2), q.sum(1)
@@ -0,0 +1,174 @@
+# S draws of the global distributions of one posterior, shared by word perplexity, location perplexity and the
+# evaluator instead of every metric (or every token of the per-token loops) drawing its own
+#
+# bank[key] is a (S, ...) float32 tensor, drawn on first lookup one sample at a time:
+#   rows      theta, pi, tau, phi, sigma, eta, mu, rho: Dirichlet(<concentration>) as the model draws them,
+#             e.g. pi (S, G, U)
+#   columns   pi_by_user, tau_by_time, phi_by_location, sigma_by_tag, mu_by_tag, rho_by_tag: one dirichlet over
+#             the groups (locations, times) per column, e.g. pi_by_user (S, U, G) = Dirichlet(gamma_q.T), the
+#             estimator of the perplexity scripts
+#   switch    one-hot lambda per row of the eta sample of the same index, (S, L, number of tag sources)
+# q is mean field, so sample s of every key together is a joint draw. every key has its own seed derived from
+# (seed, key), the draws do not depend on which keys were looked up before or in which order.
+#
+# with cache_dir a key is written to <cache_dir>/<key>-<hash of its concentration>-S<S>-seed<seed>.npy and
+# memory-mapped, later runs (and other variants of the same posterior) reuse the file. mu_by_tag and
+# rho_by_tag hold S x W x L and S x W x T floats, on large vocabularies they should go to a cache_dir.
+#
+# PointEstimates serves the same keys as a bank with a single sample, a closed form value per key instead of a
+# draw; the perplexity estimators 'plugin' and 'expected_log' score it in place of a bank.
+
+import hashlib
+import os
+import zlib
+
+import numpy as np
+import torch
+import pyro.distributions as dist
+
+import posterior_params
+
+# key -> (concentration, draw)
+SAMPLE_KEYS = {
+    'theta': ('alpha_q', 'rows'),
+    'pi': ('gamma_q', 'rows'),
+    'tau': ('kappa_q', 'rows'),
+    'phi': ('beta_q', 'rows'),
+    'sigma': ('delta_q', 'rows'),
+    'eta': ('zeta_q', 'rows'),
+    'mu': ('epsilon_q', 'rows'),
+    'rho': ('iota_q', 'rows'),
+    'pi_by_user': ('gamma_q', 'columns'),
+    'tau_by_time': ('kappa_q', 'columns'),
+    'phi_by_location': ('beta_q', 'columns'),
+    'sigma_by_tag': ('delta_q', 'columns'),
+    'mu_by_tag': ('epsilon_q', 'columns'),
+    'rho_by_tag': ('iota_q', 'columns'),
+    'switch': ('zeta_q', 'switch'),
+}
+
+
+class SampleBank:
+    def __init__(self, posterior, sample_size=10, seed=0, cache_dir=None):
+        self.posterior = posterior
+        self.sample_size = sample_size
+        self.seed = seed
+        self.cache_dir = cache_dir
+        self.samples = {}
+
+    def __contains__(self, key):
+        return key in SAMPLE_KEYS and SAMPLE_KEYS[key][0] in self.posterior
+
+    def __getitem__(self, key):
+        if key not in self.samples:
+            if key not in SAMPLE_KEYS:
+                raise KeyError(f'unknown sample key {key}, one of {list(SAMPLE_KEYS)}')
+            self.samples[key] = torch.from_numpy(self._load_or_draw(key))
+        return self.samples[key]
+
+    def sample(self, key, s):
+        return self[key][s]
+
+    def log_sample(self, key, s, index=None):
+        # log of sample s, of the rows in index only when given
+        value = self[key][s]
+        return torch.log(value if index is None else value[index])
+
+    def _concentration(self, key):
+        return torch.as_tensor(self.posterior[SAMPLE_KEYS[key][0]]).float()
+
+    def _shape(self, key):
+        name, draw = SAMPLE_KEYS[key]
+        shape = list(self.posterior[name].shape)
+        return [self.sample_size] + (shape[::-1] if draw == 'columns' else shape)
+
+    def _key_seed(self, key):
+        return (self.seed * 1000003 + zlib.crc32(key.encode())) % 2 ** 63
+
+    def cache_path(self, key):
+        digest = hashlib.sha1(self._concentration(key).numpy().tobytes()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f'{key}-{digest}-S{self.sample_size}-seed{self.seed}.npy')
+
+    def _load_or_draw(self, key):
+        if self.cache_dir is None:
+            out = np.empty(self._shape(key), dtype=np.float32)
+            self._draw(key, out)
+            return out
+
+        path = self.cache_path(key)
+        if os.path.exists(path):
+            return np.load(path, mmap_mode='c')
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # drawn into a temporary file and renamed, an interrupted run leaves no half-written bank behind
+        tmp_path = f'{path[:-len(".npy")]}.{os.getpid()}.tmp.npy'
+        out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=tuple(self._shape(key)))
+        self._draw(key, out)
+        out.flush()
+        del out
+        os.replace(tmp_path, path)
+        return np.load(path, mmap_mode='c')
+
+    def _draw(self, key, out):
+        # one sample at a time, so at most one sample of the key is held outside of out
+        name, draw = SAMPLE_KEYS[key]
+        eta = self['eta'] if draw == 'switch' else None
+        concentration = self._concentration(key)
+        if draw == 'columns':
+            concentration = concentration.T
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(self._key_seed(key))
+            for s in range(self.sample_size):
+                if draw == 'switch':
+                    value = dist.Multinomial(1, eta[s]).sample()
+                else:
+                    value = dist.Dirichlet(concentration).sample()
+                out[s] = value.numpy()
+
+
+class PointEstimates:
+    # kind 'mean': E[x] of every key, the switch gets E[eta]. the predictive probability of every model is a sum
+    #   of products of distinct, independent dirichlets (and the one-hot switch), so scoring the means is the exact
+    #   E_q[p(w | u)], not only a plug-in approximation
+    # kind 'expected_log': exp(E[log x]), the switch gets exp(E[log eta]). log of the sum over the terms then
+    #   equals logsumexp of their expected logs, which is at most E_q[log p(w | u)] (jensen, logsumexp is convex)
+    sample_size = 1
+
+    def __init__(self, posterior, kind='mean'):
+        if kind not in posterior_params.SUMMARY_KINDS:
+            raise ValueError(f'unknown point estimate {kind}, one of {posterior_params.SUMMARY_KINDS}')
+        self.posterior = posterior
+        self.kind = kind
+        # log E[x] or E[log x] of every key looked up, (1, ...)
+        self.logs = {}
+
+    def __contains__(self, key):
+        return key in SAMPLE_KEYS and SAMPLE_KEYS[key][0] in self.posterior
+
+    def __getitem__(self, key):
+        return torch.exp(self._log(key))
+
+    def sample(self, key, s):
+        return self[key][s]
+
+    def log_sample(self, key, s, index=None):
+        value = self._log(key)[s]
+        return value if index is None else value[index]
+
+    def _log(self, key):
+        if key not in self.logs:
+            self.logs[key] = self._log_estimate(key).float().unsqueeze(0)
+        return self.logs[key]
+
+    def _log_estimate(self, key):
+        if key not in SAMPLE_KEYS:
+            raise KeyError(f'unknown sample key {key}, one of {list(SAMPLE_KEYS)}')
+        name, draw = SAMPLE_KEYS[key]
+        if draw == 'switch':
+            return self._log('eta')[0]
+        if draw == 'rows':
+            value = posterior_params.summary(self.posterior, key, self.kind)
+        else:
+            concentration = torch.as_tensor(self.posterior[name]).detach().float().T
+            value = posterior_params.dirichlet_mean(concentration) if self.kind == 'mean' else \
+                posterior_params.dirichlet_expected_log(concentration)
+        return torch.log(value) if self.kind == 'mean' else value
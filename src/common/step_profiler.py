@@ -0,0 +1,202 @@
+# opt-in profiler for svi.step(): wall time per phase, allocations and peak memory per step
+#
+# phases of one step:
+#   guide        the guide function
+#   model        the model function (replayed against the guide, enumerated sites broadcast)
+#   enumeration  the rest of the ELBO: tracing, enumeration bookkeeping and the dice contraction
+#   backward     loss.backward()
+#   optimizer    the Adam update of the params seen in this step
+# memory is read from torch's autograd profiler every n-th step only, it slows the step down a lot,
+# so those steps are left out of the timings.
+# report() prints a summary table and writes <prefix>.profile.json and <prefix>.trace.json, the latter
+# opens in chrome://tracing (or https://ui.perfetto.dev).
+
+import json
+import os
+import resource
+import time
+from contextlib import contextmanager
+
+import torch
+
+PHASES = ['guide', 'model', 'enumeration', 'backward', 'optimizer']
+
+
+class _TimedOptim:
+
+    def __init__(self, profiler, optim):
+        self.profiler = profiler
+        self.optim = optim
+
+    def __call__(self, *args, **kwargs):
+        with self.profiler.phase('optimizer'):
+            return self.optim(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.optim, name)
+
+
+class StepProfiler:
+
+    def __init__(self, model_type, memory_every=50):
+        self.model_type = model_type
+        self.memory_every = memory_every
+        self.steps = []
+        self.current = None
+        self.origin = time.perf_counter()
+
+    def attach(self, svi):
+        svi.model = self.wrap(svi.model, 'model')
+        svi.guide = self.wrap(svi.guide, 'guide')
+        svi.optim = _TimedOptim(self, svi.optim)
+
+    def wrap(self, fn, name):
+        def timed(*args, **kwargs):
+            with self.phase(name):
+                return fn(*args, **kwargs)
+        return timed
+
+    @contextmanager
+    def phase(self, name):
+        if self.current is None:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.current['phases'][name] += end - start
+            self.current['events'].append((name, start, end))
+
+    @contextmanager
+    def _timed_backward(self):
+        backward = torch.Tensor.backward
+        profiler = self
+
+        def timed_backward(tensor, *args, **kwargs):
+            with profiler.phase('backward'):
+                return backward(tensor, *args, **kwargs)
+
+        torch.Tensor.backward = timed_backward
+        try:
+            yield
+        finally:
+            torch.Tensor.backward = backward
+
+    def step(self, svi, *args, **kwargs):
+        sampled = bool(self.memory_every) and len(self.steps) % self.memory_every == 0
+        self.current = {'phases': dict.fromkeys(PHASES, 0.), 'events': [], 'sampled': sampled}
+        start = time.perf_counter()
+        with self._timed_backward():
+            if sampled:
+                with torch.autograd.profiler.profile(profile_memory=True) as prof:
+                    loss = svi.step(*args, **kwargs)
+                self.current.update(memory_stats(prof.function_events))
+            else:
+                loss = svi.step(*args, **kwargs)
+        end = time.perf_counter()
+
+        record = self.current
+        self.current = None
+        record['start'] = start
+        record['total'] = end - start
+        record['phases']['enumeration'] = max(0., record['total'] - sum(record['phases'].values()))
+        self.steps.append(record)
+        return loss
+
+    def summary(self):
+        timed = [s for s in self.steps if not s['sampled']] or self.steps
+        sampled = [s for s in self.steps if s['sampled']]
+        ms = {name: [s['phases'][name] * 1000 for s in timed] for name in PHASES}
+        ms['step'] = [s['total'] * 1000 for s in timed]
+        summary = {
+            'model_type': self.model_type,
+            'steps': len(self.steps),
+            'timed_steps': len(timed),
+            'memory_steps': len(sampled),
+            'ms': {name: {'mean': _mean(values), 'median': _median(values)} for name, values in ms.items()},
+            # ru_maxrss is in kilobytes on linux
+            'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        }
+        for key in ['allocations', 'allocated_mb', 'peak_mb']:
+            summary[key] = _mean([s[key] for s in sampled])
+        return summary
+
+    def report(self, prefix):
+        if not self.steps:
+            return
+        summary = self.summary()
+        print(format_summary(summary))
+
+        directory = os.path.dirname(prefix)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        steps = [{k: v for k, v in s.items() if k not in ['events', 'start']} for s in self.steps]
+        with open(prefix + '.profile.json', 'w') as f:
+            json.dump({'summary': summary, 'steps': steps}, f)
+        with open(prefix + '.trace.json', 'w') as f:
+            json.dump({'traceEvents': self.trace_events()}, f)
+        print('Profile saved:', prefix + '.profile.json', prefix + '.trace.json')
+
+    def trace_events(self):
+        def us(t):
+            return (t - self.origin) * 1e6
+
+        events = []
+        for i, s in enumerate(self.steps):
+            events.append({'name': 'step', 'ph': 'X', 'pid': 0, 'tid': 0, 'ts': us(s['start']),
+                           'dur': s['total'] * 1e6, 'args': {'step': i, 'memory_sampled': s['sampled']}})
+            for name, start, end in s['events']:
+                events.append({'name': name, 'ph': 'X', 'pid': 0, 'tid': 1, 'ts': us(start),
+                               'dur': (end - start) * 1e6, 'args': {'step': i}})
+            if s['sampled']:
+                events.append({'name': 'memory', 'ph': 'C', 'pid': 0, 'ts': us(s['start']),
+                               'args': {'peak_mb': s['peak_mb'], 'allocated_mb': s['allocated_mb']}})
+        return events
+
+
+def memory_stats(function_events):
+    # allocations of one step from the autograd profiler: number of allocating ops, bytes allocated and the
+    # peak of the running balance of allocations and frees
+    ops = sorted(function_events, key=lambda e: e.time_range.start)
+    allocations = 0
+    allocated = 0
+    balance = 0
+    peak = 0
+    for e in ops:
+        usage = e.self_cpu_memory_usage
+        if usage > 0:
+            allocations += 1
+            allocated += usage
+        balance += usage
+        peak = max(peak, balance)
+    return {'allocations': allocations, 'allocated_mb': allocated / 2 ** 20, 'peak_mb': peak / 2 ** 20}
+
+
+def format_summary(summary):
+    total = summary['ms']['step']['mean'] or 1.
+    lines = [
+        f"step profile ({summary['model_type']}, {summary['timed_steps']} timed steps)",
+        f"{'phase':<12}{'mean ms':>10}{'median ms':>11}{'share':>8}",
+    ]
+    for name in PHASES + ['step']:
+        ms = summary['ms'][name]
+        lines.append(f"{name:<12}{ms['mean']:>10.2f}{ms['median']:>11.2f}{ms['mean'] / total:>8.1%}")
+    if summary['memory_steps']:
+        lines.append(f"memory ({summary['memory_steps']} sampled steps): {summary['allocations']:.0f} allocating ops, "
+                     f"{summary['allocated_mb']:.1f} MB allocated, {summary['peak_mb']:.1f} MB peak per step")
+    lines.append(f"max rss {summary['max_rss_mb']:.1f} MB")
+    return '\n'.join(lines)
+
+
+def _mean(values):
+    return sum(values) / len(values) if values else 0.
+
+
+def _median(values):
+    values = sorted(values)
+    if not values:
+        return 0.
+    mid = len(values) // 2
+    return values[mid] if len(values) % 2 else (values[mid - 1] + values[mid]) / 2
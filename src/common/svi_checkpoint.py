@@ -0,0 +1,67 @@
+# periodic checkpoints for long SVI runs
+# a checkpoint holds everything needed to continue svi.step() where it stopped:
+# param store, optimizer state, step counter, rng states, loss history and the train/test split
+
+import os
+
+import pyro
+import pyro.util
+import torch
+
+
+def checkpoint_path(checkpoint_dir, data_file_name, train_ratio, tags, model_type, split, rank=0, world_size=1):
+    # one checkpoint per (model, split, data file, ratio, tags) so a rerun of the same job finds it again and the
+    # other models / splits of the same file do not, data-parallel runs keep one per rank
+    name = os.path.split(data_file_name)[1].replace('.txt', '')
+    name = '_'.join([model_type, split, name, str(train_ratio)] + [t.strip('_') for t in tags])
+    if world_size > 1:
+        name += f'.rank{rank}-of-{world_size}'
+    return os.path.join(checkpoint_dir, name + '.ckpt')
+
+
+def save_checkpoint(path, step, optimizer, losses, ids, model_type):
+    state = {
+        'model_type': model_type,
+        'step': step,
+        'param_store': pyro.get_param_store().get_state(),
+        'optimizer': optimizer.get_state(),
+        'rng': pyro.util.get_rng_state(),
+        'losses': losses,
+        'training_ids': ids.training_ids,
+        'test_ids': ids.test_ids,
+    }
+
+    checkpoint_dir = os.path.dirname(path)
+    if checkpoint_dir and not os.path.exists(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+
+    # write then rename, so a crash while saving never leaves a broken checkpoint behind
+    tmp_path = path + '.tmp'
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path, model_type):
+    if not os.path.exists(path):
+        print(f'No checkpoint found in: {path}, starting from step 0')
+        return None
+
+    state = torch.load(path)
+    if state.get('model_type') != model_type:
+        # the param store of another model can have the same shapes and would be trained on silently
+        raise ValueError(f'{path} is a checkpoint of the {state.get("model_type")} model, not of {model_type}')
+    print(f'Resuming from {path} at step {state["step"]}')
+    return state
+
+
+def restore_checkpoint(state, optimizer):
+    # call after pyro.clear_param_store(); the optimizer state is consumed lazily
+    # by pyro once the params are seen again in the first svi.step()
+    pyro.get_param_store().set_state(state['param_store'])
+    optimizer.set_state(state['optimizer'])
+    pyro.util.set_rng_state(state['rng'])
+
+
+def remove_checkpoint(path):
+    if os.path.exists(path):
+        os.remove(path)
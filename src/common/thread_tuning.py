@@ -0,0 +1,196 @@
+# thread counts of a training or perplexity process
+#
+# --num-threads N fixes the intra-op and inter-op threads as before. --num-threads auto
+#   1. registers the job with a lock file in JOB_DIR and takes cores / running jobs as its share, so jobs that
+#      start on the same machine split the cores instead of each asking for all of them,
+#   2. runs a few svi steps at 1, 2, 4, ... intra-op threads up to the share and keeps the fastest count. the
+#      param store and the rng are restored afterwards, so the run continues as if the trial steps never happened,
+#   3. caches the result per (host, model, size bucket) in CACHE_FILE, later runs of that size skip step 2.
+# jobs that exit release their lock; locks of killed jobs are detected through flock and removed.
+#
+# only the intra-op threads are benchmarked. torch takes the inter-op thread count once per process, before the
+# first inter-op work, so candidates cannot be tried in one process; they are set to the share without measuring.
+# the svi steps of these models run eagerly and hardly use the inter-op pool.
+
+import atexit
+import fcntl
+import json
+import math
+import os
+import socket
+import tempfile
+import time
+
+import pyro
+import pyro.util
+import torch
+
+JOB_DIR = os.path.join(tempfile.gettempdir(), 'uem-jobs')
+CACHE_FILE = os.path.join(os.path.expanduser('~'), '.cache', 'uem', 'thread_tuning.json')
+# timed trial steps per candidate, after one warm-up step
+TRIAL_STEPS = 3
+
+_job_lock = None
+
+
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def register_job(directory=JOB_DIR):
+    # holds an exclusive flock on <directory>/<pid>.lock until the process exits
+    global _job_lock
+    if _job_lock is not None:
+        return
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'{os.getpid()}.lock')
+    # locked before it gets its .lock name, so other jobs never see it unlocked
+    tmp_path = os.path.join(directory, f'{os.getpid()}.tmp')
+    _job_lock = open(tmp_path, 'w')
+    fcntl.flock(_job_lock, fcntl.LOCK_EX)
+    os.replace(tmp_path, path)
+    atexit.register(_release_job, path)
+
+
+def _release_job(path):
+    global _job_lock
+    _job_lock.close()
+    _job_lock = None
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def running_jobs(directory=JOB_DIR):
+    # registered jobs that still hold their lock, this one included
+    count = 0
+    for name in os.listdir(directory) if os.path.isdir(directory) else []:
+        path = os.path.join(directory, name)
+        if not name.endswith('.lock'):
+            continue
+        if name == f'{os.getpid()}.lock':
+            count += 1
+            continue
+        try:
+            with open(path) as f:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # nobody holds it, the job is gone
+            os.remove(path)
+        except BlockingIOError:
+            count += 1
+        except OSError:
+            pass
+    return max(count, 1)
+
+
+def fair_share():
+    register_job()
+    return max(1, available_cores() // running_jobs())
+
+
+def candidates(share):
+    counts = [2 ** i for i in range(int(math.log2(share)) + 1)]
+    return counts if counts[-1] == share else counts + [share]
+
+
+def size_bucket(args):
+    # the enumerated (G, batch, W) tensors dominate a step, one bucket per doubling of their size
+    batch = args.get('batch_size', int(args['R'] / 5))
+    return int(math.log2(max(1, args['G'] * batch * args['W'])))
+
+
+def cache_key(model_type, args):
+    return f'{socket.gethostname()}/{model_type}/{size_bucket(args)}'
+
+
+def load_cache():
+    try:
+        with open(CACHE_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(key, value):
+    # re-read before writing, other jobs may have added entries meanwhile
+    cache = load_cache()
+    cache[key] = value
+    os.makedirs(os.path.dirname(CACHE_FILE), exist_ok=True)
+    tmp_file = f'{CACHE_FILE}.{os.getpid()}.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(cache, f, indent=1)
+    os.replace(tmp_file, CACHE_FILE)
+
+
+def snapshot():
+    state = pyro.get_param_store().get_state()
+    return {
+        'params': {name: value.detach().clone() for name, value in state['params'].items()},
+        'constraints': state['constraints'],
+        'rng': pyro.util.get_rng_state(),
+    }
+
+
+def restore(state):
+    pyro.clear_param_store()
+    pyro.get_param_store().set_state({'params': state['params'], 'constraints': state['constraints']})
+    pyro.util.set_rng_state(state['rng'])
+
+
+def benchmark(svi, data, args, counts, steps=TRIAL_STEPS):
+    # median seconds per svi step at every intra-op thread count; svi should have its own optimizer
+    state = snapshot()
+    seconds = {}
+    try:
+        for n in counts:
+            torch.set_num_threads(n)
+            svi.step(data, args)
+            durations = []
+            for _ in range(steps):
+                start = time.perf_counter()
+                svi.step(data, args)
+                durations.append(time.perf_counter() - start)
+            seconds[n] = sorted(durations)[len(durations) // 2]
+    finally:
+        restore(state)
+    return seconds
+
+
+def set_threads(n, interop=None):
+    torch.set_num_threads(n)
+    try:
+        torch.set_num_interop_threads(interop or n)
+    except RuntimeError:
+        # only possible once per process, before any inter-op work; later runs keep the first setting
+        pass
+
+
+def configure(value, model_type=None, args=None, svi=None, data=None):
+    # value is --num-threads: a number, or 'auto' to tune the intra-op threads within the fair share (needs svi,
+    # data and args to benchmark, otherwise the share itself is used) and set the inter-op threads to the share;
+    # returns the intra-op thread count
+    if value != 'auto':
+        set_threads(int(value))
+        return int(value)
+
+    share = fair_share()
+    if svi is None:
+        set_threads(share)
+        print(f'Threads: {share} (share of {available_cores()} cores)')
+        return share
+
+    key = cache_key(model_type, args)
+    cached = load_cache().get(key)
+    if cached is not None and cached['share'] >= share:
+        best = min(cached['threads'], share)
+        source = 'cached'
+    else:
+        seconds = benchmark(svi, data, args, candidates(share))
+        best = min(seconds, key=seconds.get)
+        save_cache(key, {'threads': best, 'share': share,
+                         'seconds': {str(n): round(s, 5) for n, s in seconds.items()}})
+        source = ', '.join(f'{n}: {s * 1000:.0f} ms' for n, s in seconds.items())
+    set_threads(best, share)
+    print(f'Threads: {best} intra-op, {share} inter-op of a {share} core share for {key} ({source})')
+    return best
@@ -0,0 +1,88 @@
+# warm-start a run from an existing posterior pkl:
+# base -> s / t / st, or a smaller train ratio -> a larger one on the same city
+
+import csv
+
+import pyro
+import torch
+import torch.distributions.constraints as constraints
+
+import posterior_bundle
+import posterior_params
+
+
+def read_photo_ids(filename):
+    with open(filename) as f:
+        return [row[0] for row in csv.reader(f)]
+
+
+def resize(value, shape, fill=1.):
+    # copy the overlapping block, new users / locations / tags / times start from the prior
+    resized = torch.full(shape, fill)
+    block = tuple(slice(0, min(a, b)) for a, b in zip(value.shape, shape))
+    resized[block] = value[block]
+    return resized
+
+
+def training_photo_ids(data_file, test_ids):
+    test_ids = set(test_ids.tolist())
+    return [pid for i, pid in enumerate(read_photo_ids(data_file)) if i not in test_ids]
+
+
+def match_rows(source, ids):
+    # rows of the new training set -> rows of the source g_q, matched by photo id
+    source_rows = {pid: i for i, pid in enumerate(training_photo_ids(source['data_file'], source['test_ids']))}
+    target_pids = training_photo_ids(ids.filename, ids.test_ids)
+    target = [j for j, pid in enumerate(target_pids) if pid in source_rows]
+    return torch.LongTensor(target), torch.LongTensor([source_rows[target_pids[j]] for j in target])
+
+
+def init_from_posterior(filename, ids, data, args, model_type):
+    source = posterior_bundle.load_posterior(filename)
+    if source['alpha_q'].shape[0] != args['G']:
+        raise ValueError(f"{filename} has {source['alpha_q'].shape[0]} groups, this run has {args['G']}")
+
+    shapes = posterior_params.param_shapes(args, model_type)
+    init = {}
+    for name in ['alpha_q', 'gamma_q', 'kappa_q', 'beta_q', 'delta_q']:
+        init[name] = resize(source[name].detach(), shapes[name])
+
+    # location / time specific tag distributions start from the group mixture seen there, unless the source
+    # model trained them
+    trained = posterior_params.source_params(posterior_params.infer_model_type(source))
+    theta = posterior_params.dirichlet_mean(init['alpha_q'])
+    if 'epsilon_q' in shapes:
+        if 'epsilon_q' in trained:
+            init['epsilon_q'] = resize(source['epsilon_q'].detach(), shapes['epsilon_q'])
+        else:
+            g_given_l = posterior_params.dirichlet_mean((theta.unsqueeze(1) * posterior_params.dirichlet_mean(init['beta_q'])).T)
+            init['epsilon_q'] = g_given_l @ init['delta_q']
+    if 'iota_q' in shapes:
+        if 'iota_q' in trained:
+            init['iota_q'] = resize(source['iota_q'].detach(), shapes['iota_q'])
+        else:
+            g_given_t = posterior_params.dirichlet_mean((theta.unsqueeze(1) * posterior_params.dirichlet_mean(init['kappa_q'])).T)
+            init['iota_q'] = g_given_t @ init['delta_q']
+    if 'zeta_q' in shapes:
+        if 'zeta_q' in source and source['zeta_q'].shape[1] == shapes['zeta_q'][1]:
+            init['zeta_q'] = resize(source['zeta_q'].detach(), shapes['zeta_q'])
+        else:
+            init['zeta_q'] = torch.ones(shapes['zeta_q'])
+
+    # per-row parameters: copy rows of photos the source was trained on,
+    # the others start from their responsibilities under the warm-started globals
+    q_g, q_c = posterior_params.row_responsibilities(init, data, model_type)
+    init['g_q'] = q_g
+    if 'lambda_q' in shapes:
+        init['lambda_q'] = q_c
+    if 'g_q' in source:
+        # bundles may have been saved without the per-row parameters
+        target_rows, source_rows = match_rows(source, ids)
+        init['g_q'][target_rows] = source['g_q'].detach()[source_rows]
+        if 'lambda_q' in shapes and 'lambda_q' in source and source['lambda_q'].shape[1] == shapes['lambda_q'][1]:
+            init['lambda_q'][target_rows] = source['lambda_q'].detach()[source_rows]
+        print(f'Warm start from {filename}: {len(target_rows)} / {args["R"]} rows matched')
+
+    for name, value in init.items():
+        # positive constraint works in log space, keep underflowed responsibilities finite
+        pyro.param(name, value.clamp(min=1e-8), constraint=constraints.positive)
@@ -1,30 +1,31 @@
 import argparse
 import csv
 import os
-from os.path import join, dirname
-import pandas as pd
-import numpy as np
+import sys
+from os.path import abspath, join, dirname
 import time
-from dotenv import load_dotenv
 from collections import defaultdict
 
-import boto3
-import comet_ml
+sys.path.append(join(dirname(abspath(__file__)), '..', 'common'))
+# first, so that --profile-imports also times numpy, torch and pyro
+import import_profiler
+import numpy as np
 import pyro
-import pyro.distributions as dist
 import torch
-from botocore.exceptions import ClientError
-from comet_ml import api
 from tqdm import tqdm
 
-device = torch.device("cuda:1" if torch.cuda.is_available() else "cpu")
+import posterior_bundle
+import posterior_params
+import posterior_sample_bank
 
-load_dotenv(verbose=True)
-dotenv_path = join(dirname(__file__), '.env')
-load_dotenv(dotenv_path)
+device = torch.device("cuda:1" if torch.cuda.is_available() else "cpu")
 
 
 def download_posterior(exp_key):
+    # boto3 / botocore are only needed for models kept on s3
+    import boto3
+    from botocore.exceptions import ClientError
+
     session = boto3.Session(profile_name=os.environ.get('AWS_PROFILE'))
     s3 = session.client('s3')
 
@@ -268,16 +269,14 @@ def let_user_give_feedback(data, recommend, k):
     return feedback_info
 
 
-def create_location_ranking(posterior, sample_size, method='NA'):
-    alpha_q = posterior['alpha_q'].to(device)
-    gamma_q = posterior['gamma_q'].to(device)
-    beta_q = posterior['beta_q'].to(device)
-
+def create_location_ranking(posterior, sample_size, method='NA', bank=None):
+    # the first sample_size draws of the bank, a run shares them with the recommendation weights
+    bank = bank or posterior_sample_bank.SampleBank(posterior, sample_size)
     size = torch.LongTensor([sample_size]).to(device)
     
-    theta = dist.Dirichlet(alpha_q).sample(size)
-    pi = dist.Dirichlet(gamma_q).sample(size)
-    phi = dist.Dirichlet(beta_q).sample(size)
+    theta = bank['theta'][:sample_size].to(device)
+    pi = bank['pi'][:sample_size].to(device)
+    phi = bank['phi'][:sample_size].to(device)
     pi_star = (pi.mean()*torch.ones(pi.unsqueeze(3).size()))
 
     if method == 'mix':
@@ -366,11 +365,11 @@ def evaluation_pre_and_recall(recommend_rank, k, data, save_path='NA'):
     return pre_recall_at_k
 
 
-def calc_score_base(posterior, data, method='NA',save_path='NA'):
+def calc_score_base(posterior, data, method='NA',save_path='NA', bank=None):
 
     result_metrics = {}
     sample_size = 10
-    ranking = create_location_ranking(posterior, sample_size, method)
+    ranking = create_location_ranking(posterior, sample_size, method, bank)
 
     pre_recall_at_one = evaluate_location_precision_and_recall(ranking, 1, data,save_path)
     result_metrics.update(pre_recall_at_one)
@@ -423,6 +422,8 @@ def calc_score(recommend, data_per_user, save_path='NA'):
 
 
 def run(ex):
+    from botocore.exceptions import ClientError
+
     eid = ex.id
     # filter
     if not ex.get_metrics(metric="duration"):
@@ -436,20 +437,18 @@ def run(ex):
         # download posterior
         download_posterior(eid)
 
-        posterior = torch.load(eid + '.pkl')
+        posterior = posterior_bundle.load_posterior(eid + '.pkl')
       
         repeat_time = 10
         test_data = get_test_data(posterior['data_file'], posterior['test_ids'])
         train_data = get_training_data(posterior['data_file'], posterior['test_ids'])
 
-        alpha_q = posterior['alpha_q']
-        beta_q = posterior['beta_q']
-        delta_q = posterior['delta_q']
-        theta = dist.Dirichlet(alpha_q).sample(torch.LongTensor([10000]))
-        phi = dist.Dirichlet(beta_q).sample(torch.LongTensor([10000]))
-        sigma = dist.Dirichlet(delta_q).sample(torch.LongTensor([10000]))
-        locs_prob = phi.mean(0)
-        acts_prob = sigma.mean(0)
+        # one theta draw per repetition, the location and tag distributions are the posterior means;
+        # the ranking of calc_score_base() uses the same draws
+        bank = posterior_sample_bank.SampleBank(posterior, repeat_time)
+        theta = bank['theta']
+        locs_prob = posterior_params.summary(posterior, 'phi')
+        acts_prob = posterior_params.summary(posterior, 'sigma')
 
         loc_ranking_temp = calculate_scores_for_images(locs_prob, 1000, "normal")
         act_ranking_temp = calculate_scores_for_images(acts_prob, 1000, "normal")
@@ -495,7 +494,7 @@ def run(ex):
             weights_wl = calculate_weights_using_scores(act_ranking_temp, act_scores_from_user, weights_wl)
             recommend_wl[i_r, iii, :] = recommend_according_to_weights(weights_wl, locs_prob, 'NA')#loc_scores_from_user[0, :])
 
-        metrics_base = calc_score_base(posterior, data_per_user)
+        metrics_base = calc_score_base(posterior, data_per_user, bank=bank)
         metrics_al = calc_score(recommend_al, data_per_user_new)
         metrics_wl = calc_score(recommend_wl, data_per_user_new)
         metrics_wtol = calc_score(recommend_wtol, data_per_user_new)
@@ -513,6 +512,13 @@ def run(ex):
 
 
 def main(args):
+    # comet and the .env file are only needed to look up the experiments
+    from comet_ml import api
+    from dotenv import load_dotenv
+
+    load_dotenv(verbose=True)
+    load_dotenv(join(dirname(__file__), '.env'))
+
     print(args)
     api_key = os.environ.get('COMET_API_KEY')
     workspace_name = os.environ.get('COMET_WORKSPACE')
@@ -535,6 +541,8 @@ if __name__ == '__main__':
     pyro.enable_validation()
     parser = argparse.ArgumentParser(description='pyro model evaluation')
     parser.add_argument('--debug', action='store_true', help='debug mode')
+    parser.add_argument('--profile-imports', action='store_true',
+            help='print the import time per module at exit')
 
     args = parser.parse_args()
 
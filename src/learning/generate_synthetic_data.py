@@ -0,0 +1,166 @@
+# synthetic id files sampled from the generative process of the base / s / t / st models
+#
+# the global distributions (theta, pi, tau, phi, sigma and eta, mu, rho where the model has them) are drawn
+# once from their dirichlet priors, then the photos are drawn chunk by chunk and appended to the output, so
+# tens of millions of rows never have to be in memory at once. the output has the format of the training
+# files: pid,u,t,l,"tag1,...,tagN"
+#
+#   python generate_synthetic_data.py -m st -R 10000000 -U 20000 -L 2000 -W 30000 -T 24 -o synth.txt \
+#       --test-rows 1000000 --test-output synth_test.txt --truth synth_truth.pkl
+
+import argparse
+import os
+import sys
+import time
+from os.path import abspath, join, dirname
+
+import torch
+import pyro.distributions as dist
+
+sys.path.append(join(dirname(abspath(__file__)), '..', 'common'))
+import posterior_params
+
+
+def sample_globals(args, model_type, concentration=1.):
+    def dirichlet(*shape):
+        return dist.Dirichlet(torch.full(shape, concentration)).sample()
+
+    G, U, T, L, W = (args[k] for k in ['G', 'U', 'T', 'L', 'W'])
+    truth = {
+        'theta': dirichlet(G),
+        'pi': dirichlet(G, U),
+        'tau': dirichlet(G, T),
+        'phi': dirichlet(G, L),
+        'sigma': dirichlet(G, W),
+    }
+    sources = posterior_params.SWITCH_SOURCES[model_type]
+    if model_type != 'base':
+        # switch probabilities per location, per time in the t model
+        truth['eta'] = dirichlet(T if model_type == 't' else L, len(sources))
+    if 'location' in sources:
+        truth['mu'] = dirichlet(L, W)
+    if 'time' in sources:
+        truth['rho'] = dirichlet(T, W)
+    return truth
+
+
+def stacked_cdf(probs):
+    # the cdfs of all rows as one increasing sequence, row k covers (k, k + 1]
+    cdf = probs.double().cumsum(-1)
+    cdf = cdf / cdf[..., -1:]
+    if cdf.dim() == 1:
+        return cdf
+    return (cdf + torch.arange(len(cdf), dtype=torch.float64).unsqueeze(1)).reshape(-1)
+
+
+def draw(stacked, n_values, rows, size=1):
+    # inverse-cdf draws from row rows[i] of a stacked cdf, (len(rows), size)
+    u = rows.double().unsqueeze(1) + torch.rand(len(rows), size, dtype=torch.float64)
+    index = torch.searchsorted(stacked, u) - rows.unsqueeze(1) * n_values
+    return index.clamp(0, n_values - 1)
+
+
+class Sampler:
+
+    def __init__(self, truth, model_type, len_w):
+        self.model_type = model_type
+        self.len_w = len_w
+        self.sources = posterior_params.SWITCH_SOURCES[model_type]
+        self.cdf = {name: stacked_cdf(probs) for name, probs in truth.items()}
+        self.size = {name: probs.shape[-1] for name, probs in truth.items()}
+
+    def draw(self, name, rows, size=1):
+        return draw(self.cdf[name], self.size[name], rows, size)
+
+    def sample(self, n):
+        # u, t, l (n,) and tags (n, lenW) of n photos
+        g = draw(self.cdf['theta'], self.size['theta'], torch.zeros(n, dtype=torch.long)).squeeze(1)
+        u = self.draw('pi', g).squeeze(1)
+        t = self.draw('tau', g).squeeze(1)
+        l = self.draw('phi', g).squeeze(1)
+
+        # every tag of a photo comes from the source its switch picked
+        if self.model_type == 'base':
+            return u, t, l, self.draw('sigma', g, self.len_w)
+        c = self.draw('eta', t if self.model_type == 't' else l).squeeze(1)
+        tags = torch.empty(n, self.len_w, dtype=torch.long)
+        for i, source in enumerate(self.sources):
+            picked = c == i
+            if not picked.any():
+                continue
+            if source == 'location':
+                tags[picked] = self.draw('mu', l[picked], self.len_w)
+            elif source == 'time':
+                tags[picked] = self.draw('rho', t[picked], self.len_w)
+            else:
+                tags[picked] = self.draw('sigma', g[picked], self.len_w)
+        return u, t, l, tags
+
+
+def write_rows(f, pid_start, u, t, l, tags):
+    lines = []
+    for i, (ui, ti, li, row_tags) in enumerate(zip(u.tolist(), t.tolist(), l.tolist(), tags.tolist())):
+        lines.append(f'{pid_start + i},{ui},{ti},{li},"{",".join(map(str, row_tags))}"\n')
+    f.write(''.join(lines))
+
+
+def generate(sampler, filename, n_rows, chunk_size, pid_start=0):
+    with open(filename, 'w') as f:
+        written = 0
+        while written < n_rows:
+            n = min(chunk_size, n_rows - written)
+            write_rows(f, pid_start + written, *sampler.sample(n))
+            written += n
+            print(f'{filename}: {written}/{n_rows} rows', end='\r')
+    print()
+
+
+def main(args):
+    print(args)
+    torch.manual_seed(args.seed)
+    vi_args = {'G': args.G, 'U': args.U, 'T': args.T, 'L': args.L, 'W': args.W}
+
+    start = time.time()
+    truth = sample_globals(vi_args, args.model, args.concentration)
+    sampler = Sampler(truth, args.model, args.lenW)
+
+    for filename in [args.output, args.test_output]:
+        directory = os.path.dirname(filename or '')
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+    generate(sampler, args.output, args.R, args.chunk_size)
+    if args.test_output and args.test_rows:
+        # test photos continue the photo ids of the training file
+        generate(sampler, args.test_output, args.test_rows, args.chunk_size, pid_start=args.R)
+    if args.truth:
+        truth.update({'model_type': args.model, 'args': dict(vi_args, lenW=args.lenW, R=args.R)})
+        torch.save(truth, args.truth)
+    print(f'Done in {time.time() - start:.1f}s')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='synthetic id files from the generative process of the models')
+    parser.add_argument('-m', '--model', default='st', choices=['base', 's', 't', 'st'])
+    parser.add_argument('-o', '--output', required=True, type=str,
+            help='id file to write')
+    parser.add_argument('-R', default=100000, type=int, help='number of photos')
+    parser.add_argument('-U', default=1000, type=int, help='number of users')
+    parser.add_argument('-L', default=500, type=int, help='number of locations')
+    parser.add_argument('-W', default=2000, type=int, help='number of tags')
+    parser.add_argument('-T', default=24, type=int, help='number of time slots')
+    parser.add_argument('-G', default=10, type=int, help='number of groups')
+    parser.add_argument('--lenW', default=4, type=int, help='tags per photo')
+    parser.add_argument('--concentration', default=1., type=float,
+            help='concentration of the dirichlet priors (the models use 1)')
+    parser.add_argument('--test-output', default=None, type=str,
+            help='also write a test id file drawn from the same distributions')
+    parser.add_argument('--test-rows', default=0, type=int)
+    parser.add_argument('--truth', default=None, type=str,
+            help='save the sampled distributions to this pkl')
+    parser.add_argument('--chunk-size', default=100000, type=int,
+            help='photos sampled and written at a time')
+    parser.add_argument('--seed', default=0, type=int)
+
+    args = parser.parse_args()
+
+    main(args)
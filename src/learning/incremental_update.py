@@ -0,0 +1,180 @@
+# incremental update of a trained posterior when new photos arrive for a city
+#
+# the old concentrations already hold prior + expected counts of the old rows, so new rows are folded in
+# with a few coordinate ascent passes over the new rows only:
+#   local pass:  q(g, c) of every new row under the current globals
+#   global pass: globals = old globals + expected counts of the new rows
+# the cost is proportional to the new rows, old rows keep their q(g, c)
+
+import argparse
+import csv
+import os
+import sys
+from os.path import abspath, join, dirname
+
+import torch
+
+sys.path.append(join(dirname(abspath(__file__)), '..', 'common'))
+import posterior_bundle
+import posterior_params
+import warm_start
+
+
+def read_rows(filename, skip_ids=()):
+    pids = []
+    us = []
+    ts = []
+    ls = []
+    tag_matrix = []
+
+    with open(filename) as f:
+        reader = csv.reader(f)
+
+        for row in reader:
+            if row[0] in skip_ids:
+                continue
+            pids.append(row[0])
+            us.append(int(row[1]))
+            ts.append(int(row[2]))
+            ls.append(int(row[3]))
+            tag_matrix.append([int(t) for t in row[4].split(",")])
+
+    data = {
+        'u': torch.LongTensor(us),
+        't': torch.LongTensor(ts),
+        'l': torch.LongTensor(ls),
+        'tag': torch.LongTensor(tag_matrix).reshape(len(tag_matrix), -1).T if tag_matrix else
+               torch.zeros(0, 0, dtype=torch.long)
+    }
+
+    return pids, data
+
+
+def extended_args(posterior, data, model_type):
+    args = {
+        'G': posterior['alpha_q'].shape[0],
+        'U': max(posterior['gamma_q'].shape[1], int(data['u'].max()) + 1),
+        'T': max(posterior['kappa_q'].shape[1], int(data['t'].max()) + 1),
+        'L': max(posterior['beta_q'].shape[1], int(data['l'].max()) + 1),
+        'W': max(posterior['delta_q'].shape[1], int(data['tag'].max()) + 1),
+        'R': len(data['u']),
+    }
+    if model_type == 't':
+        # the t model indexes the location-sized zeta by time
+        args['L'] = max(args['L'], args['T'])
+    return args
+
+
+def expected_counts(q, data, args, model_type):
+    # expected sufficient statistics of the rows for every global concentration
+    u, t, l, tags = data['u'], data['t'], data['l'], data['tag']
+    sources = posterior_params.SWITCH_SOURCES[model_type]
+    shapes = posterior_params.param_shapes(args, model_type)
+    q_g = q.sum(2)
+    q_c = q.sum(1)
+
+    counts = {name: torch.zeros(shapes[name]) for name in shapes if name not in posterior_params.LOCAL_PARAMS}
+    counts['alpha_q'] += q_g.sum(0)
+    counts['gamma_q'].index_add_(1, u, q_g.T)
+    counts['kappa_q'].index_add_(1, t, q_g.T)
+    counts['beta_q'].index_add_(1, l, q_g.T)
+
+    q_group = q[:, :, sources.index('group')]
+    for tag in tags:
+        counts['delta_q'].index_add_(1, tag, q_group.T)
+        if 'location' in sources:
+            counts['epsilon_q'].index_put_((l, tag), q_c[:, sources.index('location')], accumulate=True)
+        if 'time' in sources:
+            counts['iota_q'].index_put_((t, tag), q_c[:, sources.index('time')], accumulate=True)
+
+    if model_type != 'base':
+        counts['zeta_q'].index_add_(0, t if model_type == 't' else l, q_c)
+
+    return counts
+
+
+def update_posterior(posterior, data, passes=10, tol=1e-4):
+    model_type = posterior_params.infer_model_type(posterior)
+    args = extended_args(posterior, data, model_type)
+    shapes = posterior_params.param_shapes(args, model_type)
+
+    old = {name: warm_start.resize(posterior[name].detach(), shapes[name])
+           for name in shapes if name not in posterior_params.LOCAL_PARAMS}
+    current = dict(old)
+
+    q = None
+    for i in range(passes):
+        log_joint = posterior_params.row_log_joint(posterior_params.log_expectations(current), data, model_type)
+        q_new = torch.softmax(log_joint.reshape(args['R'], -1), 1).reshape(log_joint.shape)
+
+        counts = expected_counts(q_new, data, args, model_type)
+        current = {name: old[name] + counts[name] for name in old}
+
+        change = 1. if q is None else (q_new - q).abs().max().item()
+        q = q_new
+        print(f'pass {i + 1}/{passes}: max change of q(g, c) {change:.6f}')
+        if change < tol:
+            break
+
+    updated = dict(posterior)
+    updated.update(current)
+    updated.update(posterior_params.summaries(current))
+    if 'g_q' in posterior:
+        updated['g_q'] = torch.cat([posterior['g_q'].detach(), q.sum(2)])
+    if 'lambda_q' in posterior:
+        updated['lambda_q'] = torch.cat([posterior['lambda_q'].detach(), q.sum(1)])
+
+    return updated
+
+
+def check_held_out(posterior, pids):
+    # the test rows of the original file must stay out of the posterior, the perplexity scripts still score the
+    # updated posterior on its data_file / test_ids
+    original = warm_start.read_photo_ids(posterior['data_file'])
+    used = {original[i] for i in posterior['test_ids'].tolist()}.intersection(pids)
+    if used:
+        raise ValueError(f'{len(used)} test rows of {posterior["data_file"]} would be folded into the update')
+
+
+def main(args):
+    print(args)
+    posterior = posterior_bundle.load_posterior(args.posterior)
+
+    # photos the model has already seen are not counted twice, and no row of the original file comes in:
+    # its test rows were never trained on but stay held out for the perplexity of the updated posterior
+    update_files = posterior.get('update_files', [])
+    seen = set(warm_start.read_photo_ids(posterior['data_file']))
+    for filename in update_files:
+        seen.update(warm_start.read_photo_ids(filename))
+    pids, data = read_rows(args.file, seen)
+    if not pids:
+        print(f'No new photos in: {args.file}')
+        sys.exit()
+    print(f'{len(pids)} new photos in: {args.file}')
+    check_held_out(posterior, pids)
+
+    updated = update_posterior(posterior, data, args.passes, args.tol)
+    updated['update_files'] = update_files + [args.file]
+
+    stem, ext = os.path.splitext(args.posterior.rstrip('/'))
+    output = args.output or stem + '_updated' + (ext or '.pkl')
+    posterior_bundle.save_posterior(output, updated)
+    print('Saving data done:', output)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='incremental update of a trained posterior')
+    parser.add_argument('-p', '--posterior', required=True, type=str,
+            help='posterior pkl or bundle to update')
+    parser.add_argument('-f', '--file', required=True, type=str,
+            help='id file with the new photos, same format as the training files')
+    parser.add_argument('-o', '--output', default=None, type=str,
+            help='output pkl, or bundle if it ends with .bundle (default: <posterior>_updated.pkl/.bundle)')
+    parser.add_argument('--passes', default=10, type=int,
+            help='maximum number of local/global update passes over the new photos')
+    parser.add_argument('--tol', default=1e-4, type=float,
+            help='stop once q(g, c) of the new photos changes less than this')
+
+    args = parser.parse_args()
+
+    main(args)
@@ -1,23 +1,34 @@
 # %load ./new_base_for_sightseeing_SingleFile.py
 
-from comet_ml import Experiment
-
 import argparse
 import os
 import sys
-from os.path import join, dirname
+from os.path import abspath, join, dirname
 import time
 # from dotenv import load_dotenv
 import pickle
 from glob import glob
 
-import matplotlib.pyplot as plt
+sys.path.append(join(dirname(abspath(__file__)), '..', '..', 'common'))
+# first, so that --profile-imports also times torch and pyro
+import import_profiler
 import torch
 import torch.distributions.constraints as constraints
 from tqdm import tqdm
 
 # import boto3
 import time_split_ids_data as ids_data
+import svi_checkpoint
+import warm_start
+import data_parallel
+import multi_city
+import metrics_sink
+import step_profiler
+import memory_planner
+import posterior_bundle
+import posterior_codec
+import posterior_params
+import thread_tuning
 #import test_ids_data as ids_data
 import pyro
 import pyro.distributions as dist
@@ -26,9 +37,8 @@ from pyro.infer import SVI, JitTraceEnum_ELBO, TraceEnum_ELBO, config_enumerate
 from pyro.optim import Adam
 # from slack_notificater import SlackNotificater
 
-plt.style.use('seaborn')
-torch.set_num_threads(16)
-torch.set_num_interop_threads(16)
+
+MODEL_TYPE = 'base'
 
 # load_dotenv(verbose=True)
 # dotenv_path = join(dirname(__file__), '.env')
@@ -75,20 +85,87 @@ def guide(data=None, args=None):
         sigma = pyro.sample('sigma', dist.Dirichlet(delta_q))
 
     g_q = pyro.param('g_q', torch.ones(args['R'], args['G']), constraint=constraints.positive)
-    with pyro.plate('data', args['R'], subsample_size=int(args['R'] / 5)) as ind:
+    with pyro.plate('data', args['R'], subsample_size=args.get('batch_size', int(args['R'] / 5)),
+                    subsample=data_parallel.subsample_rows(args)) as ind:
         g = pyro.sample('g_{}'.format(ind), dist.Categorical(g_q.index_select(0, ind)))
 
     return theta, pi, phi, sigma, g
 
-def save_posterior(filename, ids):
+@config_enumerate
+def city_model(data=None, args=None):
+    # model() for several cities at once (see multi_city.py): global latents get an outer city plate,
+    # row c of them belongs to city c and the padded entries are masked out
+    city_plate = pyro.plate('city', args['C'], dim=-2)
+    with city_plate:
+        alpha = torch.ones(args['G'])
+        theta = pyro.sample('theta', dist.Dirichlet(alpha)).squeeze(-2)
+
+    with city_plate, pyro.plate('group', args['G']):
+        gamma = torch.ones(args['U'])
+        kappa = torch.ones(args['T'])
+        beta = torch.ones(args['L'])
+        delta = torch.ones(args['W'])
+        pi = pyro.sample('pi', dist.Dirichlet(gamma))
+        tau = pyro.sample('tau', dist.Dirichlet(kappa))
+        phi = pyro.sample('phi', dist.Dirichlet(beta))
+        sigma = pyro.sample('sigma', dist.Dirichlet(delta))
+    pi = multi_city.restrict(pi, data['u_mask'].unsqueeze(1))
+    tau = multi_city.restrict(tau, data['t_mask'].unsqueeze(1))
+    phi = multi_city.restrict(phi, data['l_mask'].unsqueeze(1))
+    sigma = multi_city.restrict(sigma, data['w_mask'].unsqueeze(1))
+
+    with pyro.plate('data', args['R']) as ind:
+        c = data['city'][ind]
+        g = pyro.sample('g_{}'.format(ind), dist.Categorical(theta[c]))
+        pyro.sample('u_{}'.format(ind), dist.Categorical(pi[c, g]), obs=data['u'][ind])
+        pyro.sample('t_{}'.format(ind), dist.Categorical(tau[c, g]), obs=data['t'][ind])
+        pyro.sample('l_{}'.format(ind), dist.Categorical(phi[c, g]), obs=data['l'][ind])
+
+        with pyro.plate('tag_plate_{}'.format(ind), args['lenW']):
+            pyro.sample('tag_{}'.format(ind), dist.Categorical(sigma[c, g]), obs=data['tag'].index_select(1, ind))
+
+@config_enumerate
+def city_guide(data=None, args=None):
+    city_plate = pyro.plate('city', args['C'], dim=-2)
+    alpha_q = pyro.param('alpha_q', torch.ones(args['C'], args['G']), constraint=constraints.positive)
+    with city_plate:
+        theta = pyro.sample('theta', dist.Dirichlet(alpha_q.unsqueeze(1)))
+
+    gamma_q = pyro.param('gamma_q', torch.ones(args['C'], args['G'], args['U']), constraint=constraints.positive)
+    kappa_q = pyro.param('kappa_q', torch.ones(args['C'], args['G'], args['T']), constraint=constraints.positive)
+    beta_q = pyro.param('beta_q', torch.ones(args['C'], args['G'], args['L']), constraint=constraints.positive)
+    delta_q = pyro.param('delta_q', torch.ones(args['C'], args['G'], args['W']), constraint=constraints.positive)
+    with city_plate, pyro.plate('group', args['G']):
+        pi = pyro.sample('pi', dist.Dirichlet(gamma_q))
+        tau = pyro.sample('tau', dist.Dirichlet(kappa_q))
+        phi = pyro.sample('phi', dist.Dirichlet(beta_q))
+        sigma = pyro.sample('sigma', dist.Dirichlet(delta_q))
+
+    g_q = pyro.param('g_q', torch.ones(args['R'], args['G']), constraint=constraints.positive)
+    with pyro.plate('data', args['R'], subsample_size=args.get('batch_size', int(args['R'] / 5))) as ind:
+        g = pyro.sample('g_{}'.format(ind), dist.Categorical(g_q.index_select(0, ind)))
+
+    return theta, pi, phi, sigma, g
+
+def save_posterior(filename, ids, tags, params=None, save_format='pkl', quantize=None, locals_mode='keep'):
     posterior_dic = {}
-    for name in pyro.get_param_store():
-        posterior_dic[name] = pyro.param(name)
+    if params is None:
+        params = {name: pyro.param(name) for name in pyro.get_param_store()}
+    posterior_dic.update(params)
+    # normalised means and expected logs of the global dirichlets, so point estimates need no sampling
+    posterior_dic.update(posterior_params.summaries(params))
 
     posterior_dic['test_ids'] = ids.test_ids
     posterior_dic['data_file'] = ids.filename
-    posterior_dic['tags'] = ';'.join(args.add_tags)
-    torch.save(posterior_dic, filename)
+    posterior_dic['tags'] = ';'.join(tags)
+    if quantize or locals_mode != 'keep':
+        # compact storage, posterior_bundle.load_posterior() decodes it
+        posterior_dic = posterior_codec.encode_posterior(posterior_dic, quantize, locals_mode)
+    if save_format == 'bundle':
+        # one memory-mappable file per parameter, see posterior_bundle.py
+        posterior_bundle.write_bundle(os.path.splitext(filename)[0] + '.bundle', posterior_dic)
+    else:
+        torch.save(posterior_dic, filename)
 #     upload_s3(filename)
 
 # def upload_s3(file_name):
@@ -146,25 +223,15 @@ def save_posterior(filename, ids):
 
 #     sn.send_slack_request(data)
 
+def create_experiment(args):
+    if data_parallel.rank() > 0:
+        # only rank 0 reports, the other ranks train replicas of the same parameters
+        return metrics_sink.MetricsSink([])
+    return metrics_sink.create_sink(args.metrics_backend, args.metrics_dir, args.debug)
+
 def run(args, group_count, step_count, data_file_name, train_ratio=0.8):
     
-    if args.debug:
-        experiment = Experiment(
-                api_key=os.environ.get('COMET_API_KEY'),
-                project_name="test",
-                workspace=os.environ.get('COMET_WORKSPACE'),
-                auto_output_logging='simple')
-    else:
-        experiment = Experiment(
-            api_key="rAOeE45NqnekTXmKrqg0Do12C",
-            project_name="uem-training",
-            workspace="707728642li",
-        )
-#         experiment = Experiment(
-#                 api_key=os.environ.get('COMET_API_KEY'),
-#                 project_name=os.environ.get('COMET_PROJECT'),
-#                 workspace=os.environ.get('COMET_WORKSPACE'),
-#                 auto_output_logging='simple')
+    experiment = create_experiment(args)
 
     hyper_params = {
             'group_count': group_count,
@@ -185,8 +252,24 @@ def run(args, group_count, step_count, data_file_name, train_ratio=0.8):
 
     print('Collecting data....')
     ids_data_in = ids_data.IdsData(data_file_name, group_count)
-    ids_data_in.divide_dataset(ratio=train_ratio)
+    checkpoint_file = svi_checkpoint.checkpoint_path(args.checkpoint_dir, data_file_name, train_ratio, args.add_tags,
+                                                     MODEL_TYPE, 'split_by_time', data_parallel.rank(),
+                                                     args.world_size)
+    checkpoint = svi_checkpoint.load_checkpoint(checkpoint_file, MODEL_TYPE) if args.resume else None
+    if checkpoint is None:
+        ids_data_in.divide_dataset(ratio=train_ratio)
+    else:
+        # keep the split of the interrupted run, divide_dataset() is random
+        ids_data_in.training_ids = checkpoint['training_ids']
+        ids_data_in.test_ids = checkpoint['test_ids']
+    if args.world_size > 1:
+        data_parallel.broadcast_split(ids_data_in)
     data, vi_args = ids_data_in.get_training_set()
+    if args.batch_size:
+        vi_args['batch_size'] = args.batch_size
+    if args.memory_budget:
+        vi_args['batch_size'] = memory_planner.check_budget(vi_args, MODEL_TYPE, memory_planner.parse_size(args.memory_budget),
+                                                            args.auto_batch)
     print('Collecting data done')
 
     print('Optimizing....')
@@ -194,27 +277,124 @@ def run(args, group_count, step_count, data_file_name, train_ratio=0.8):
     optimizer = Adam(adam_param)
 
     pyro.clear_param_store()
-    svi = SVI(model, guide, optimizer, loss=TraceEnum_ELBO(max_plate_nesting=2))
+    if checkpoint is not None:
+        svi_checkpoint.restore_checkpoint(checkpoint, optimizer)
+    elif args.init_from:
+        warm_start.init_from_posterior(args.init_from, ids_data_in, data, vi_args, MODEL_TYPE)
+    if args.world_size > 1:
+        vi_args.update(data_parallel.shard_args(vi_args))
+        svi = data_parallel.DataParallelSVI(model, guide, optimizer, loss=TraceEnum_ELBO(max_plate_nesting=2))
+    else:
+        svi = SVI(model, guide, optimizer, loss=TraceEnum_ELBO(max_plate_nesting=2))
+        # data-parallel ranks split the cores in data_parallel.launch(); the trial steps of --num-threads auto
+        # get their own optimizer and leave the param store as it was
+        thread_tuning.configure(args.num_threads, MODEL_TYPE, vi_args,
+                                SVI(model, guide, Adam(adam_param), loss=TraceEnum_ELBO(max_plate_nesting=2)), data)
+    profiler = step_profiler.StepProfiler(MODEL_TYPE, args.profile_memory_every) if args.profile else None
+    if profiler is not None:
+        profiler.attach(svi)
 
     with experiment.train():
-        losses = []
+        losses = [] if checkpoint is None else checkpoint['losses']
+        start_step = 0 if checkpoint is None else checkpoint['step']
         n_steps = step_count # args.num_step
-        for step in tqdm(range(n_steps)):
-            loss = svi.step(data, args=vi_args)
+        for step in tqdm(range(start_step, n_steps), initial=start_step, total=n_steps,
+                         disable=data_parallel.rank() > 0):
+            loss = profiler.step(svi, data, args=vi_args) if profiler else svi.step(data, args=vi_args)
             losses.append(loss)
             experiment.log_metric('loss', loss, step=step)
+            if args.checkpoint_every and (step + 1) % args.checkpoint_every == 0:
+                svi_checkpoint.save_checkpoint(checkpoint_file, step + 1, optimizer, losses, ids_data_in,
+                                               MODEL_TYPE)
 
     duration = time.time() - start
     experiment.log_metric('duration', duration)
     print('Optimizing done.')
+    if profiler is not None and data_parallel.rank() == 0:
+        profiler.report(os.path.join(args.profile_dir, experiment.get_key()))
+    if args.world_size > 1:
+        svi.gather_local_params(vi_args['rows'])
+        if data_parallel.rank() > 0:
+            # keep this rank's checkpoint until rank 0 has saved the posterior
+            data_parallel.barrier()
+            svi_checkpoint.remove_checkpoint(checkpoint_file)
+            experiment.end()
+            return
     
     if not os.path.exists("./pkl_model"):
         os.mkdir("./pkl_model")
     print('Saving data...in ./pkl_model')
-    save_posterior("./pkl_model/" + experiment.get_key() + '.pkl', ids_data_in)
+    save_posterior("./pkl_model/" + experiment.get_key() + '.pkl', ids_data_in, args.add_tags, save_format=args.save_format,
+                   quantize=args.quantize, locals_mode=args.locals)
 #     with open('./test/' + experiment.get_key() + '.pkl',"wb") as f:
 #         pickle.dump(ids_data_in,f)
     
+    data_parallel.barrier()
+    svi_checkpoint.remove_checkpoint(checkpoint_file)
+    print('Saving data done.')
+
+    experiment.end()
+
+def run_multi_city(args, group_count, step_count, data_file_names, train_ratio=0.8):
+    # every city of data_file_names in one SVI loop, saved as one posterior pkl per city
+    experiment = create_experiment(args)
+
+    hyper_params = {
+            'group_count': group_count,
+            'train_ratio': train_ratio,
+            }
+    adam_param = {'lr': 0.001, 'betas': (0.95, 0.999)}
+    hyper_params.update(adam_param)
+    hyper_params.update(vars(args))
+
+    experiment.set_cmd_args()
+    tags = [os.path.split(f)[1].split(".")[0] for f in data_file_names] + [str(train_ratio), 'multi_city']
+    tags = tags + args.add_tags if args.add_tags else tags
+    experiment.add_tags(tags)
+    experiment.log_parameters(hyper_params)
+
+    print('Collecting data....')
+    ids_list = []
+    for data_file_name in data_file_names:
+        ids_data_in = ids_data.IdsData(data_file_name, group_count)
+        ids_data_in.divide_dataset(ratio=train_ratio)
+        ids_list.append(ids_data_in)
+    data, vi_args, city_args = multi_city.stack_cities(ids_list)
+    if args.batch_size:
+        vi_args['batch_size'] = args.batch_size
+    if args.memory_budget:
+        vi_args['batch_size'] = memory_planner.check_budget(vi_args, MODEL_TYPE, memory_planner.parse_size(args.memory_budget),
+                                                            args.auto_batch)
+    print('Collecting data done')
+
+    print('Optimizing....')
+    start = time.time()
+    optimizer = Adam(adam_param)
+
+    pyro.clear_param_store()
+    svi = SVI(city_model, city_guide, optimizer, loss=TraceEnum_ELBO(max_plate_nesting=2))
+    thread_tuning.configure(args.num_threads, MODEL_TYPE, vi_args,
+                            SVI(city_model, city_guide, Adam(adam_param), loss=TraceEnum_ELBO(max_plate_nesting=2)), data)
+    profiler = step_profiler.StepProfiler(MODEL_TYPE, args.profile_memory_every) if args.profile else None
+    if profiler is not None:
+        profiler.attach(svi)
+
+    with experiment.train():
+        for step in tqdm(range(step_count)):
+            loss = profiler.step(svi, data, vi_args) if profiler else svi.step(data, vi_args)
+            experiment.log_metric('loss', loss, step=step)
+
+    duration = time.time() - start
+    experiment.log_metric('duration', duration)
+    print('Optimizing done.')
+    if profiler is not None and data_parallel.rank() == 0:
+        profiler.report(os.path.join(args.profile_dir, experiment.get_key()))
+
+    print('Saving data...')
+    params = {name: pyro.param(name) for name in pyro.get_param_store()}
+    for c, ids_data_in in enumerate(ids_list):
+        save_posterior("./pkl_model/" + experiment.get_key() + '_' + str(c) + '.pkl', ids_data_in, args.add_tags,
+                       multi_city.city_posterior(params, c, city_args), args.save_format, args.quantize, args.locals)
     print('Saving data done.')
 
     experiment.end()
@@ -235,10 +415,20 @@ def main(args):
             print(each)
         if args.check_input:
             sys.exit()
+    if args.multi_city:
+        for ratio in train_ratios:
+            run_multi_city(args, group_count, step_count, all_files, ratio)
+        return
     for data_file_name in all_files:
         for ratio in train_ratios:
             try:
-                run(args, group_count, step_count, data_file_name, ratio)
+                if args.world_size > 1:
+                    data_parallel.launch(run, args.world_size, args.master_port,
+                                         (args, group_count, step_count, data_file_name, ratio), args.seed)
+                else:
+                    if args.seed is not None:
+                        pyro.set_rng_seed(args.seed)
+                    run(args, group_count, step_count, data_file_name, ratio)
             except Exception as err:
                 print(err)
 
@@ -261,6 +451,49 @@ if __name__ == '__main__':
     parser.add_argument('-c', '--check_input', action='store_true', 
             help='only check you input files')
     parser.add_argument('-t','--add_tags',nargs='*',default=[],)
+    parser.add_argument('--checkpoint-dir', default='./checkpoints', type=str,
+            help='directory for periodic training checkpoints')
+    parser.add_argument('--checkpoint-every', default=1000, type=int,
+            help='save a checkpoint every N steps (0 disables checkpointing)')
+    parser.add_argument('--resume', action='store_true',
+            help='continue from the latest checkpoint of the same file/ratio/tags')
+    parser.add_argument('--init-from', default=None, type=str,
+            help='seed the shared parameters from an existing posterior pkl')
+    parser.add_argument('--world-size', default=1, type=int,
+            help='number of data-parallel training processes on this machine')
+    parser.add_argument('--master-port', default=29500, type=int,
+            help='localhost port used by the data-parallel processes')
+    parser.add_argument('--seed', default=None, type=int,
+            help='random seed; data-parallel rank r uses seed + r (a random base seed when not given)')
+    parser.add_argument('--multi-city', action='store_true',
+            help='train all files of --file jointly in one model with a city plate')
+    parser.add_argument('--metrics-backend', nargs='*', default=['jsonl'], choices=metrics_sink.BACKENDS,
+            help='where training metrics go, no value for no metrics (comet reads COMET_API_KEY)')
+    parser.add_argument('--metrics-dir', default='./metrics', type=str,
+            help='directory of the jsonl / sqlite metrics')
+    parser.add_argument('--profile', action='store_true',
+            help='time the phases of every svi step, write a summary and a chrome trace to --profile-dir')
+    parser.add_argument('--profile-dir', default='./profiles', type=str,
+            help='directory of the step profiles')
+    parser.add_argument('--profile-memory-every', default=50, type=int,
+            help='measure allocations and peak memory every N steps (0 disables)')
+    parser.add_argument('--batch-size', default=None, type=int,
+            help='rows per svi step (default: a fifth of the training rows)')
+    parser.add_argument('--memory-budget', default=None, type=str,
+            help='refuse to train when the estimated peak memory exceeds this, e.g. 8G')
+    parser.add_argument('--auto-batch', action='store_true',
+            help='shrink the batch size to fit --memory-budget instead of refusing')
+    parser.add_argument('--save-format', default='pkl', choices=['pkl', 'bundle'],
+            help='posterior as one pkl, or as a bundle directory of memory-mappable arrays')
+    parser.add_argument('--quantize', default=None, choices=posterior_codec.CODECS,
+            help='store g_q, gamma_q, epsilon_q and iota_q in this precision')
+    parser.add_argument('--locals', default='keep', choices=posterior_codec.LOCALS,
+            help='keep, drop or zlib-compress the per-row parameters (g_q, lambda_q)')
+    parser.add_argument('--profile-imports', action='store_true',
+            help='print the import time per module at exit')
+    parser.add_argument('--num-threads', default='16', type=str,
+            help="torch threads, or 'auto' to benchmark the intra-op threads of a few steps within this job's share "
+                 "of the cores (inter-op threads are set to the share, not benchmarked)")
     
     args = parser.parse_args()
     
@@ -0,0 +1,369 @@
+# batched monte carlo word / location perplexity given the user, for the base, location, timeaware and union
+# models of the perplexity scripts
+#
+# calc_word_perplexity_given_user*() loop over every (photo, tag) token and draw fresh dirichlets for each one.
+# here the draws come from a posterior_sample_bank.SampleBank: every one of its samples covers all tokens, the
+# columns the test tokens need are gathered per token by index, and the log likelihoods of a chunk of tokens
+# come from a few contractions. word and location perplexity given the same bank share its theta / pi draws.
+# the estimator is the one of the loops:
+#   - Dirichlet(gamma_q[:, u]), Dirichlet(delta_q[:, w]), ... over the groups (locations, times) for the user /
+#     tag / location column of a token, the bank's pi_by_user, sigma_by_tag, ... keys
+#   - one-hot switches lambda drawn from eta for every location (time in the timeaware model), the tag
+#     marginalised over the locations / times
+#   - perplexity exp(-(sum over tokens of the mean over samples of log p) / n)
+# in the location model the loop broadcasts sigma over a second group axis and sums it out, and so scales the
+# mu term by G: sum_{g,l} theta_pi[g] phi[g,l] (G lambda_0[l] mu[l] + lambda_1[l] sum_h sigma[h]). location_formula
+# 'loop' (the default) keeps that formula, so the perplexities stay comparable with earlier runs; 'model' follows
+# the model, the tag of the group switch uses the group of its own photo and mu is not scaled.
+#
+# everything is computed in log space: each model's sum over groups, locations and times is one opt_einsum
+# expression per tag source, evaluated with pyro's log-sum-exp backend (the one TraceEnum_ELBO contracts with)
+# and combined with logsumexp, so no product of probabilities underflows. opt_einsum picks the contraction
+# order and contracts the token independent factors once per sample. tokens are scored in chunks of at most
+# CHUNK_BYTES of gathered rows (chunk_size tokens when given).
+#
+# skipped tokens are counted and left out of n, where the loops drop them silently but keep them in n:
+#   - a user / tag / location outside the posterior
+#   - a log likelihood that is not finite after averaging over the samples (a zero in a float32 dirichlet draw)
+#
+# the per-token log likelihoods are also summed per user, location and time slot of the token's photo
+# (breakdown()), from the same likelihood matrix.
+#
+# the monte carlo error of a perplexity comes from the per-sample terms of its estimator (sample_terms()): the mean
+# over tokens of log p for the 'log' average, of p / (the mean of p over the samples) for 'probability', the delta
+# method around the log-mean-exp. tokens share the draws, so the terms are taken per sample over all tokens
+# instead of per token, which keeps the correlation between tokens in the error. standard_error() is the error of
+# the log perplexity (the relative error of the perplexity), from the samples only; the variation of the test set
+# is not in it. adaptive_perplexity() draws further banks of samples until it is below a target.
+#
+# streaming_perplexity() scores test data given block by block and keeps only running sums, so its memory
+# does not grow with the test set.
+#
+# user_groups = (user ids, (users, G) log p(g | u)) replaces theta * pi[:, u] of those users, e.g. the users
+# fold_in.py infers for the user split; they are scored even when they lie outside gamma_q.
+
+import math
+
+import opt_einsum
+import torch
+
+from posterior_sample_bank import SampleBank
+
+# memory of the rows gathered per chunk of tokens (theta * pi, sigma, mu, rho of each token)
+CHUNK_BYTES = 64 * 2 ** 20
+LOG_BACKEND = 'pyro.ops.einsum.torch_log'
+# how the log likelihoods of a token are averaged over the samples:
+#   log          mean of log p, the estimator of the loops
+#   probability  log of the mean of p (log-mean-exp), converges to the plugin estimator
+SAMPLE_AVERAGES = ['log', 'probability']
+# word likelihood of the location model: 'loop' as calc_word_perplexity_given_user_with_location_model(), 'model'
+# as the generative model
+LOCATION_FORMULAS = ['loop', 'model']
+
+
+def _user_positions(u, user_groups):
+    # row of every user of u in the log p(g | u) of user_groups, -1 for the users it does not have
+    ids = user_groups[0].to(u.device)
+    size = max([int(u.max()) if len(u) else 0, int(ids.max()) if len(ids) else 0]) + 1
+    positions = torch.full((size,), -1, dtype=torch.long, device=u.device)
+    positions[ids] = torch.arange(len(ids), device=u.device)
+    return positions[u]
+
+
+def _known_users(posterior, u, user_groups=None):
+    # users with a gamma_q column or in user_groups
+    known = u < posterior['gamma_q'].shape[1]
+    if user_groups is not None:
+        known = known | (_user_positions(u, user_groups) >= 0)
+    return known
+
+
+def _log_theta_pi(draw, users, user_groups=None, device=None):
+    # (users, G) log theta * pi[:, u], or the log p(g | u) of user_groups for the users it has
+    if user_groups is None:
+        return draw('theta') + draw('pi_by_user', users)
+    positions = _user_positions(users, user_groups)
+    folded = positions >= 0
+    result = user_groups[1][positions.clamp(min=0)].to(device)
+    if not folded.all():
+        result[~folded.to(device)] = draw('theta') + draw('pi_by_user', users[~folded])
+    return result
+
+
+def word_tokens(posterior, test_data, user_groups=None):
+    # flattened (photo, tag) tokens: index into the unique users / tags, the photo of every token and the number
+    # of skipped tokens
+    n_tags = test_data['tag'].shape[1]
+    u = test_data['u'].repeat_interleave(n_tags)
+    w = test_data['tag'].reshape(-1)
+    valid = _known_users(posterior, u, user_groups) & (w < posterior['delta_q'].shape[1])
+    users, u_index = torch.unique(u[valid], return_inverse=True)
+    words, w_index = torch.unique(w[valid], return_inverse=True)
+    photos = torch.arange(len(test_data['u']), device=valid.device).repeat_interleave(n_tags)[valid]
+    return users, u_index, words, w_index, photos, int((~valid).sum())
+
+
+def _chunk_tokens(row_width, chunk_size=None):
+    # tokens per chunk, so that a chunk gathers about CHUNK_BYTES of float32 rows of row_width values per token
+    return chunk_size or max(1, CHUNK_BYTES // (4 * row_width))
+
+
+def _chunked(fn, n, chunk_size):
+    return torch.cat([fn(slice(start, start + chunk_size)) for start in range(0, n, chunk_size)]) if n else \
+        torch.zeros(0)
+
+
+def _log_likelihood(log_theta_pi, u_index, sources, w_index, chunk_size=None):
+    # log sum over the tag sources of the contraction of every source: (tokens,)
+    # sources are (equation, constants, emission): the operands of equation are the (tokens, G) log theta * pi
+    # of the token's user, the token independent constants, and the (tokens, width) emission row of its tag
+    G = log_theta_pi.shape[1]
+    n = _chunk_tokens(G + sum(emission.shape[1] for _, _, emission in sources), chunk_size)
+    terms = []
+    for equation, constants, emission in sources:
+        shapes = [(n, G)] + list(constants) + [(n, emission.shape[1])]
+        expression = opt_einsum.contract_expression(equation, *shapes,
+                                                    constants=list(range(1, len(constants) + 1)))
+        terms.append((expression, emission))
+
+    def chunk(c):
+        tp = log_theta_pi[u_index[c]]
+        w = w_index[c]
+        return torch.logsumexp(torch.stack([expression(tp, emission[w], backend=LOG_BACKEND)
+                                            for expression, emission in terms]), 0)
+
+    return _chunked(chunk, len(u_index), n)
+
+
+def word_log_likelihood_sample(bank, s, model_type, users, u_index, words, w_index, chunk_size=None,
+                               device=None, user_groups=None, location_formula='loop'):
+    # log p(w | u) of every token under sample s of the bank: (tokens,)
+    def draw(key, index=None):
+        return bank.log_sample(key, s, index).to(device)
+
+    log_theta_pi = _log_theta_pi(draw, users, user_groups, device)
+    sigma = draw('sigma_by_tag', words)
+
+    if model_type in ['base', 'time']:
+        sources = [('ng,ng->n', [], sigma)]
+    elif model_type == 'location':
+        lmd = draw('switch')
+        phi = draw('phi')
+        if location_formula == 'model':
+            sources = [
+                ('ng,gl,l,nl->n', [phi, lmd[:, 0]], draw('mu_by_tag', words)),
+                ('ng,gl,l,ng->n', [phi, lmd[:, 1]], sigma),
+            ]
+        elif location_formula == 'loop':
+            # sigma over its own group axis h, summed out, and the mu term G times
+            sources = [
+                ('ng,gl,l,nl->n', [phi, lmd[:, 0]], draw('mu_by_tag', words) + math.log(sigma.shape[1])),
+                ('ng,gl,l,nh->n', [phi, lmd[:, 1]], sigma),
+            ]
+        else:
+            raise ValueError(f'unknown location formula {location_formula}, one of {LOCATION_FORMULAS}')
+    elif model_type == 'timeaware':
+        tau = draw('tau')
+        # eta is stored per location, the timeaware model uses its first T rows for the time slots
+        lmd = draw('switch')[:tau.shape[1]]
+        sources = [
+            ('ng,gt,t,nt->n', [tau, lmd[:, 0]], draw('rho_by_tag', words)),
+            ('ng,gt,t,ng->n', [tau, lmd[:, 1]], sigma),
+        ]
+    elif model_type == 'union':
+        lmd = draw('switch')
+        phi = draw('phi')
+        # sum_{g,l,t} theta_pi[g] phi[g,l] tau[g,t] p(w | g,l,t)
+        sources = [
+            ('ng,gl,l,nl->n', [phi, lmd[:, 0]], draw('mu_by_tag', words)),
+            ('ng,gl,l,gt,nt->n', [phi, lmd[:, 1], draw('tau')], draw('rho_by_tag', words)),
+            ('ng,gl,l,ng->n', [phi, lmd[:, 2]], sigma),
+        ]
+    else:
+        raise ValueError(f'unknown model type {model_type}')
+
+    return _log_likelihood(log_theta_pi, u_index, sources, w_index, chunk_size)
+
+
+def word_log_likelihoods(posterior, model_type, test_data, sample_size=10, chunk_size=None, device=None,
+                         bank=None, user_groups=None, location_formula='loop'):
+    # (samples, tokens) log likelihoods of the tokens inside the posterior, the photo of every token and the
+    # number of skipped tokens
+    bank = bank or SampleBank(posterior, sample_size)
+    users, u_index, words, w_index, photos, skipped = word_tokens(posterior, test_data, user_groups)
+    # the bank lives on the cpu, the columns are gathered there and only the gathered rows move to device
+    users, words, u_index, w_index = users.cpu(), words.cpu(), u_index.to(device), w_index.to(device)
+    samples = [word_log_likelihood_sample(bank, s, model_type, users, u_index, words, w_index, chunk_size, device,
+                                          user_groups, location_formula)
+               for s in range(bank.sample_size)]
+    return torch.stack(samples), photos, skipped
+
+
+def location_log_likelihoods(posterior, test_data, sample_size=10, device=None, bank=None, user_groups=None):
+    # (samples, photos) log p(l | u) under Dirichlet(gamma_q[:, u]) and Dirichlet(beta_q[:, l]) over the groups,
+    # the index of every photo scored and the number of skipped photos
+    bank = bank or SampleBank(posterior, sample_size)
+    u, l = test_data['u'].cpu(), test_data['l'].cpu()
+    valid = _known_users(posterior, u, user_groups) & (l < posterior['beta_q'].shape[1])
+    users, u_index = torch.unique(u[valid], return_inverse=True)
+    locations, l_index = torch.unique(l[valid], return_inverse=True)
+    u_index, l_index = u_index.to(device), l_index.to(device)
+    samples = []
+    for s in range(bank.sample_size):
+        def draw(key, index=None):
+            return bank.log_sample(key, s, index).to(device)
+
+        log_theta_pi = _log_theta_pi(draw, users, user_groups, device)
+        phi = bank.log_sample('phi_by_location', s, locations).to(device)
+        samples.append(_log_likelihood(log_theta_pi, u_index, [('ng,ng->n', [], phi)], l_index))
+    return torch.stack(samples), torch.nonzero(valid).reshape(-1).to(device), int((~valid).sum())
+
+
+def token_log_likelihoods(log_likelihoods, sample_average='log'):
+    # (tokens,) log likelihood of every token, averaged over the samples
+    if sample_average == 'log':
+        return log_likelihoods.mean(0)
+    if sample_average == 'probability':
+        return torch.logsumexp(log_likelihoods, 0) - math.log(len(log_likelihoods))
+    raise ValueError(f'unknown sample average {sample_average}, one of {SAMPLE_AVERAGES}')
+
+
+def perplexity(per_token, skipped=0):
+    # exp of minus the mean log likelihood per scored token, and the number of skipped tokens
+    finite = torch.isfinite(per_token)
+    skipped += int((~finite).sum())
+    n = int(finite.sum())
+    value = torch.exp(-per_token[finite].sum() / n).item() if n else float('nan')
+    return value, skipped
+
+
+def sample_terms(log_likelihoods, per_token, sample_average='log'):
+    # (samples,) sum over the finite tokens of every sample's term of the estimator, additive over tokens
+    finite = torch.isfinite(per_token)
+    log_likelihoods = log_likelihoods[:, finite].double()
+    if sample_average == 'log':
+        return log_likelihoods.sum(1)
+    return torch.exp(log_likelihoods - per_token[finite].double()).sum(1)
+
+
+def standard_error(terms, tokens):
+    # monte carlo standard error of the log perplexity, from the sample_terms() of tokens tokens
+    if len(terms) < 2 or not tokens:
+        return float('nan')
+    return (terms / tokens).std().item() / math.sqrt(len(terms))
+
+
+def breakdown(per_token, photos, test_data, posterior):
+    # sum of the finite token log likelihoods and number of such tokens per user, location and time slot of
+    # their photos, numpy arrays '<user|location|time>_<log_likelihood|tokens>' of at least the posterior's size
+    finite = torch.isfinite(per_token)
+    log_likelihood = per_token[finite].double().cpu()
+    parts = {}
+    for name, key, param in [('user', 'u', 'gamma_q'), ('location', 'l', 'beta_q'), ('time', 't', 'kappa_q')]:
+        index = test_data[key][photos][finite].cpu()
+        size = max(posterior[param].shape[1], int(index.max()) + 1 if len(index) else 0)
+        parts[f'{name}_log_likelihood'] = torch.zeros(size, dtype=torch.float64) \
+            .scatter_add_(0, index, log_likelihood).numpy()
+        parts[f'{name}_tokens'] = torch.zeros(size, dtype=torch.int64) \
+            .scatter_add_(0, index, torch.ones_like(index)).numpy()
+    return parts
+
+
+def _perplexity(log_likelihoods, photos, skipped, test_data, posterior, sample_average):
+    per_token = token_log_likelihoods(log_likelihoods, sample_average)
+    value, skipped = perplexity(per_token, skipped)
+    terms = sample_terms(log_likelihoods, per_token, sample_average)
+    return (value, skipped, breakdown(per_token, photos, test_data, posterior),
+            standard_error(terms, int(torch.isfinite(per_token).sum())))
+
+
+def word_perplexity(posterior, model_type, test_data, sample_size=10, chunk_size=None, device=None,
+                    bank=None, sample_average='log', user_groups=None, location_formula='loop'):
+    # perplexity, number of skipped tokens, the breakdown() of the tokens and the standard_error()
+    log_likelihoods, photos, skipped = word_log_likelihoods(posterior, model_type, test_data, sample_size,
+                                                            chunk_size, device, bank, user_groups,
+                                                            location_formula)
+    return _perplexity(log_likelihoods, photos, skipped, test_data, posterior, sample_average)
+
+
+def location_perplexity(posterior, test_data, sample_size=10, device=None, bank=None, sample_average='log',
+                        user_groups=None):
+    log_likelihoods, photos, skipped = location_log_likelihoods(posterior, test_data, sample_size, device, bank,
+                                                                user_groups)
+    return _perplexity(log_likelihoods, photos, skipped, test_data, posterior, sample_average)
+
+
+def adaptive_perplexity(posterior, model_type, test_data, target_se, batch_size=10, max_samples=1000,
+                        chunk_size=None, device=None, sample_average='log', user_groups=None, cache_dir=None,
+                        seed=0, location_formula='loop'):
+    # {'word': ..., 'location': ...} (perplexity, skipped, breakdown, standard error, number of samples). banks of
+    # batch_size samples with seeds seed, seed + 1, ... are scored until the standard_error() of a metric is
+    # below target_se or max_samples are drawn; the first bank is the one of word_perplexity() with that seed.
+    # the log likelihoods of all samples drawn are kept, (samples, tokens) floats per metric
+    scorers = {
+        'word': lambda bank: word_log_likelihoods(posterior, model_type, test_data, chunk_size=chunk_size,
+                                                  device=device, bank=bank, user_groups=user_groups,
+                                                  location_formula=location_formula),
+        'location': lambda bank: location_log_likelihoods(posterior, test_data, device=device, bank=bank,
+                                                          user_groups=user_groups),
+    }
+    scored = {metric: {'batches': [], 'se': float('nan')} for metric in scorers}
+    for b in range(max(1, math.ceil(max_samples / batch_size))):
+        bank = SampleBank(posterior, batch_size, seed + b, cache_dir)
+        for metric, score in scorers.items():
+            state = scored[metric]
+            if state['se'] < target_se:
+                continue
+            log_likelihoods, state['photos'], state['skipped'] = score(bank)
+            state['batches'].append(log_likelihoods)
+            log_likelihoods = torch.cat(state['batches'])
+            per_token = token_log_likelihoods(log_likelihoods, sample_average)
+            state['se'] = standard_error(sample_terms(log_likelihoods, per_token, sample_average),
+                                         int(torch.isfinite(per_token).sum()))
+        if all(state['se'] < target_se for state in scored.values()):
+            break
+    return {metric: _perplexity(torch.cat(state['batches']), state['photos'], state['skipped'], test_data,
+                                posterior, sample_average) + (len(state['batches']) * batch_size,)
+            for metric, state in scored.items()}
+
+
+def _add_parts(total, parts):
+    # total += parts, the arrays of total grown to the longer of both
+    for name, value in parts.items():
+        shorter = total.get(name)
+        if shorter is not None and len(shorter) > len(value):
+            shorter, value = value, shorter
+        merged = value.copy()
+        if shorter is not None:
+            merged[:len(shorter)] += shorter
+        total[name] = merged
+
+
+def streaming_perplexity(posterior, model_type, blocks, sample_size=10, chunk_size=None, device=None, bank=None,
+                         sample_average='log', location_formula='loop'):
+    # {'word': ..., 'location': ...} (perplexity, skipped, breakdown, standard error) of all the test data dicts in
+    # blocks, as word_perplexity() / location_perplexity() of them concatenated; every block is scored with the
+    # same bank
+    bank = bank or SampleBank(posterior, sample_size)
+    totals = {metric: {'log_likelihood': 0., 'tokens': 0, 'skipped': 0, 'breakdown': {}, 'terms': 0.}
+              for metric in ['word', 'location']}
+    for block in blocks:
+        scored = {
+            'word': word_log_likelihoods(posterior, model_type, block, chunk_size=chunk_size, device=device,
+                                         bank=bank, location_formula=location_formula),
+            'location': location_log_likelihoods(posterior, block, device=device, bank=bank),
+        }
+        for metric, (log_likelihoods, photos, skipped) in scored.items():
+            per_token = token_log_likelihoods(log_likelihoods, sample_average)
+            finite = torch.isfinite(per_token)
+            total = totals[metric]
+            total['log_likelihood'] += per_token[finite].double().sum().item()
+            total['tokens'] += int(finite.sum())
+            total['skipped'] += skipped + int((~finite).sum())
+            _add_parts(total['breakdown'], breakdown(per_token, photos, block, posterior))
+            # the terms of a token only need its own samples, so they add up over the blocks too
+            total['terms'] = total['terms'] + sample_terms(log_likelihoods, per_token, sample_average)
+    return {metric: (torch.exp(torch.tensor(-total['log_likelihood'] / total['tokens'])).item()
+                     if total['tokens'] else float('nan'), total['skipped'], total['breakdown'],
+                     standard_error(torch.as_tensor(total['terms']).reshape(-1), total['tokens']))
+            for metric, total in totals.items()}
@@ -4,19 +4,30 @@ import os
 import sys
 import time
 from collections import defaultdict
+from functools import partial
+from os.path import abspath, join, dirname
 
+sys.path.append(join(dirname(abspath(__file__)), '..', 'common'))
+# first, so that --profile-imports also times torch and pyro
+import import_profiler
 # import boto3
-import comet_ml
+import numpy as np
 import pyro
 import pyro.distributions as dist
 import torch
 # from botocore.exceptions import ClientError
-from comet_ml import api
 from tqdm import tqdm
 
+import posterior_bundle
+import thread_tuning
+import batched_perplexity
+import fold_in
+import perplexity_pool
+import posterior_sample_bank
+
 device = torch.device("cuda:3" if torch.cuda.is_available() else "cpu")
-torch.set_num_threads(32)
-torch.set_num_interop_threads(32)
+# deterministic estimators -> posterior_sample_bank.PointEstimates kind
+ESTIMATOR_KINDS = {'plugin': 'mean', 'expected_log': 'expected_log'}
 
 
 def calc_perplexity(ids, sample_num=10):
@@ -65,6 +76,29 @@ def get_test_data(data_file, test_ids):
 
     return data
 
+def read_test_file(test_file):
+    n_test = len(open(test_file).readlines())-1
+    return get_test_data(test_file, range(n_test))
+
+def read_test_blocks(test_file, block_rows):
+    # the rows of read_test_file() as test data of at most block_rows rows each, without holding the file
+    with open(test_file) as f:
+        n_test = sum(1 for _ in f) - 1
+    with open(test_file) as f:
+        rows = []
+        for i, row in enumerate(csv.reader(f)):
+            if i >= n_test:
+                break
+            rows.append(row)
+            if len(rows) == block_rows or i == n_test - 1:
+                yield {
+                    'u': torch.LongTensor([int(row[1]) for row in rows]).to(device),
+                    't': torch.LongTensor([int(row[2]) for row in rows]).to(device),
+                    'l': torch.LongTensor([int(row[3]) for row in rows]).to(device),
+                    'tag': torch.LongTensor([[int(t) for t in row[4].split(",")] for row in rows]).to(device)
+                }
+                rows = []
+
 def divide_data_by_user(data, posterior):
     user_count = posterior['gamma_q'].shape[1]
     location_count= posterior['beta_q'].shape[1]
@@ -279,12 +313,71 @@ def calc_location_perplexity_given_user(posterior, test_data, sample_size=100):
 
     return perplexity.to('cpu').item()
 
-def calc_score(posterior, model_type, test_data):
+def calc_score(posterior, model_type, test_data, engine='batched', sample_cache=None, estimator='mc',
+               sample_average='log', breakdown_file=None, fold_in_photos=0, test_blocks=None, target_se=0.,
+               max_samples=1000, location_formula='loop'):
     if model_type not in ['base', 'time', 'location', 'union', 'timeaware']:
         return
 
     result_metrics = {}
 
+    if engine == 'batched' or estimator != 'mc' or fold_in_photos or test_blocks is not None:
+        # every sample covers all test tokens at once, see batched_perplexity.py; both perplexities score the
+        # same 10 draws of the globals, or the closed form point estimates without sampling
+        if estimator == 'mc':
+            bank = posterior_sample_bank.SampleBank(posterior, 10, cache_dir=sample_cache)
+        else:
+            bank = posterior_sample_bank.PointEstimates(posterior, ESTIMATOR_KINDS[estimator])
+        user_groups = None
+        if fold_in_photos:
+            # the test users were held out of training: their groups come from their first photos, the
+            # remaining photos are scored
+            observed, test_data = fold_in.split_first_photos(test_data, fold_in_photos)
+            user_groups = fold_in.fold_in(posterior, observed)
+            print(f'folded in {len(user_groups[0])} users from {len(observed["u"])} photos')
+        if test_blocks is not None:
+            scores = batched_perplexity.streaming_perplexity(posterior, model_type, test_blocks, device=device,
+                                                             bank=bank, sample_average=sample_average,
+                                                             location_formula=location_formula)
+        elif target_se:
+            # banks of 10 samples until the standard error of the log perplexity is below target_se
+            scores = batched_perplexity.adaptive_perplexity(posterior, model_type, test_data, target_se,
+                                                            max_samples=max_samples, device=device,
+                                                            sample_average=sample_average, user_groups=user_groups,
+                                                            cache_dir=sample_cache,
+                                                            location_formula=location_formula)
+            print('samples drawn:', scores['word'][4], 'word,', scores['location'][4], 'location')
+        else:
+            scores = {}
+            scores['word'] = batched_perplexity.word_perplexity(
+                posterior, model_type, test_data, device=device, bank=bank, sample_average=sample_average,
+                user_groups=user_groups, location_formula=location_formula)
+            scores['location'] = batched_perplexity.location_perplexity(
+                posterior, test_data, device=device, bank=bank, sample_average=sample_average,
+                user_groups=user_groups)
+        (w_perplexity_u, w_skipped, w_breakdown, w_se), (l_perplexity_u, l_skipped, l_breakdown, l_se) = \
+            scores['word'][:4], scores['location'][:4]
+        print('word_perplexity_given_user:', w_perplexity_u,
+              f'(log standard error {w_se:.2g}, {w_skipped} tokens skipped)')
+        print('location_perplexity_given_user:', l_perplexity_u,
+              f'(log standard error {l_se:.2g}, {l_skipped} photos skipped)')
+        result_metrics.update({'word_perplexity_given_user': w_perplexity_u,
+                               'location_perplexity_given_user': l_perplexity_u,
+                               'word_tokens_skipped': w_skipped,
+                               'location_tokens_skipped': l_skipped})
+        if estimator == 'mc':
+            # monte carlo error of the perplexity (delta method), the point estimates have none
+            result_metrics.update({'word_perplexity_se': w_perplexity_u * w_se,
+                                   'location_perplexity_se': l_perplexity_u * l_se,
+                                   'word_samples': scores['word'][4] if target_se else bank.sample_size,
+                                   'location_samples': scores['location'][4] if target_se else bank.sample_size})
+        if breakdown_file:
+            # log likelihood sums and token counts per user / location / time slot, one array per column
+            os.makedirs(dirname(abspath(breakdown_file)), exist_ok=True)
+            np.savez(breakdown_file, **{'word_' + k: v for k, v in w_breakdown.items()},
+                     **{'location_' + k: v for k, v in l_breakdown.items()})
+        return result_metrics
+
     # calc perplexity
     if model_type in ['base', 'time']:
         w_perplexity_u = calc_word_perplexity_given_user(posterior, test_data, 10)
@@ -313,19 +406,15 @@ def calc_score(posterior, model_type, test_data):
 
     return result_metrics
 
-def run(ex):
+def run(ex, engine='batched', sample_cache=None, estimator='mc', sample_average='log', breakdown_dir=None,
+        fold_in_photos=0, stream_rows=0, target_se=0., max_samples=1000,
+        location_formula='loop'):
     eid = ex.split(".")[0]
     # download posterior
 #     download_posterior(eid)
 
-    d = torch.load("./pkl_model/" + eid + '.pkl')
+    d = posterior_bundle.load_posterior("./pkl_model/" + ex)
 
-    # prepare test data
-    test_file = d['data_file'].replace("train","test")
-    print(test_file)
-    n_test = len(open(test_file).readlines())-1
-    test_id_tensor = torch.arange(n_test).to(device)
-    test_data = get_test_data(test_file, test_id_tensor)
     model_dict = {"base" : "base",
                   "_s_" : "location",#
                   "_t_" : "timeaware",#timeaware
@@ -343,12 +432,23 @@ def run(ex):
     if "split_by_time" in d["tags"]:
 #         if os.path.exists(eid + '.pkl'): os.remove(eid + '.pkl')       
         return
+
+    # prepare test data, parsed once per test file for all models trained on it
+    test_file = d['data_file'].replace("train","test")
+    print(test_file)
+    if stream_rows:
+        # read block by block while scoring, see batched_perplexity.streaming_perplexity()
+        test_data, test_blocks = None, read_test_blocks(test_file, stream_rows)
+    else:
+        test_data, test_blocks = perplexity_pool.test_set(test_file, read_test_file), None
     
     print(d["tags"])
 #     print(model_type)
     print('start: ', eid, "\n")
     
-    metrics = calc_score(d,model_type, test_data)
+    breakdown_file = join(breakdown_dir, eid + '.npz') if breakdown_dir else None
+    metrics = calc_score(d,model_type, test_data, engine, sample_cache, estimator, sample_average, breakdown_file,
+                         fold_in_photos, test_blocks, target_se, max_samples, location_formula)
 #     metrics = calc_score(d,"timeaware", test_data)
 #     metrics = calc_score(d,"base", test_data)
     
@@ -367,24 +467,65 @@ def run(ex):
 #         print('Could not remove: ', eid + '.pkl')
 
     print('done: ', eid, "\n")
+    return dict(metrics, model_type=model_type, test_file=test_file) if metrics else None
 # except ClientError:
 #     print('error: ', eid, "\n")
 #         return
 
 def main(args):
+    # 'auto': this job's share of the cores, the scoring has no steps to benchmark
+    threads = thread_tuning.configure(args.num_threads)
 
-    exs = sorted([i for i in os.listdir("./pkl_model") if i.endswith("pkl")])
-    n_total = len(exs)
-    for i,ex in enumerate(exs):
-        print(f' {i+1} / {n_total} ',file = sys.stderr )
-        run(ex)
+    exs = sorted([i for i in os.listdir("./pkl_model") if i.endswith("pkl") or i.endswith(".bundle")])
+    score = partial(run, engine=args.engine, sample_cache=args.sample_cache, estimator=args.estimator,
+                    sample_average=args.sample_average, breakdown_dir=args.breakdown, fold_in_photos=args.fold_in,
+                    stream_rows=args.stream_rows, target_se=args.target_se, max_samples=args.max_samples,
+                    location_formula=args.location_formula)
+    perplexity_pool.evaluate(exs, score, args.results, args.workers, threads)
 
 if __name__ == '__main__':
     assert pyro.__version__.startswith('1.3.1')
     pyro.enable_validation()
     parser = argparse.ArgumentParser(description='pyro model evaluation')
     parser.add_argument('--debug', action='store_true', help='debug mode')
+    parser.add_argument('--profile-imports', action='store_true',
+            help='print the import time per module at exit')
+    parser.add_argument('--num-threads', default='32', type=str,
+            help="torch threads, or 'auto' for this job's share of the cores")
+    parser.add_argument('--engine', default='batched', choices=['batched', 'loop'],
+            help='batched: all tokens per sample at once, loop: the per-token loops')
+    parser.add_argument('--sample-cache', default=None, type=str,
+            help='directory to keep the posterior samples of the batched engine in, reused by later runs')
+    parser.add_argument('--estimator', default='mc', choices=['mc'] + list(ESTIMATOR_KINDS),
+            help='mc: 10 posterior samples, plugin: E_q[p] from the posterior means (a perplexity at most the mc '
+                 'one), expected_log: from exp(E_q[log]) (at least the perplexity with the switches marginalised); '
+                 'the last two are deterministic')
+    parser.add_argument('--sample-average', default='log', choices=batched_perplexity.SAMPLE_AVERAGES,
+            help='log: mean of log p over the samples (the loops), probability: log of the mean of p')
+    parser.add_argument('--location-formula', default='loop', choices=batched_perplexity.LOCATION_FORMULAS,
+            help="word perplexity of the location model in the batched engine, loop: the loop's formula (mu term "
+                 'G times, sigma summed over the groups), model: the generative model; the two are not comparable')
+    parser.add_argument('--workers', default=1, type=int,
+            help='models scored in parallel, each worker gets --num-threads / workers threads')
+    parser.add_argument('--results', default='./perplexity_user_split.csv', type=str,
+            help='csv table the metrics of every model are appended to; models already in it are skipped')
+    parser.add_argument('--breakdown', default=None, type=str,
+            help='directory for <model>.npz with the log likelihood per user, location and time slot')
+    parser.add_argument('--target-se', default=0., type=float,
+            help='draw banks of 10 samples until the standard error of the log perplexity (about the relative '
+                 'error of the perplexity) is below this, instead of a fixed 10')
+    parser.add_argument('--max-samples', default=1000, type=int,
+            help='most samples drawn per model with --target-se')
+    parser.add_argument('--stream-rows', default=0, type=int,
+            help='read and score the test file in blocks of this many rows, for test sets too large for memory')
+    parser.add_argument('--fold-in', default=0, type=int,
+            help='infer the groups of every held-out user from their first N photos and score the rest')
 	
     args = parser.parse_args()
+    if args.target_se and (args.estimator != 'mc' or args.stream_rows):
+        parser.error('--target-se draws samples over the whole test set, only with --estimator mc and without '
+                     '--stream-rows')
+    if args.fold_in and args.stream_rows:
+        parser.error("--fold-in needs each user's first photos from the whole test file, not with --stream-rows")
     
     main(args)
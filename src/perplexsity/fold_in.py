@@ -0,0 +1,67 @@
+# fold-in of the users held out by the user split, whose gamma_q columns were never trained
+#
+# the first k photos of every test user (in file order) are observed, the rest are scored. the trained globals
+# stay fixed and only the user's group distribution psi_u = p(g | u), in place of theta * pi[:, u], is inferred
+# from the observed photos, for all users at once:
+#   q_r(g)  proportional to psi_u(g) p(photo r | g), p(photo | g) summed over the tag sources of the model with
+#           the expected logs of the globals (posterior_params.row_log_joint(), as the guide's row updates)
+#   psi_u   (prior * E[theta] + sum over the user's observed photos of q_r) / (prior + number of them)
+# repeated until psi stops changing, a few closed form steps per user instead of retraining. the scored photos
+# then use log psi_u for the groups of their user, see batched_perplexity's user_groups.
+
+import torch
+
+import posterior_params
+
+ITERATIONS = 50
+TOLERANCE = 1e-5
+
+
+def split_first_photos(test_data, k):
+    # (observed, scored) test data: the first k photos of every user, and the remaining ones
+    u = test_data['u']
+    rows = torch.arange(len(u), device=u.device)
+    # users in order, each user's photos in file order
+    order = torch.argsort(u * len(u) + rows)
+    _, counts = torch.unique_consecutive(u[order], return_counts=True)
+    starts = torch.repeat_interleave(torch.cumsum(counts, 0) - counts, counts)
+    rank = torch.empty_like(rows)
+    rank[order] = rows - starts
+    observed = rank < k
+    return ({key: value[observed] for key, value in test_data.items()},
+            {key: value[~observed] for key, value in test_data.items()})
+
+
+def photo_log_likelihoods(posterior, data, model_type=None):
+    # (photos, G) log p(l, t, tags | g) with the tag sources summed out, from the expected logs of the globals
+    log_e = posterior_params.log_expectations(posterior)
+    G = len(log_e['theta'])
+    # the user enters through psi, the rows only see their location, time and tags
+    log_e['theta'] = torch.zeros(G)
+    log_e['pi'] = torch.zeros(G, 1)
+    rows = {'u': torch.zeros_like(data['u']), 't': data['t'], 'l': data['l'], 'tag': data['tag'].T}
+    model_type = model_type or posterior_params.infer_model_type(posterior)
+    return torch.logsumexp(posterior_params.row_log_joint(log_e, rows, model_type), 2)
+
+
+def fold_in(posterior, observed, prior=1., iterations=ITERATIONS):
+    # (user ids, (users, G) log psi) of the users with observed photos inside the posterior's vocabulary
+    sizes = {'l': posterior['beta_q'].shape[1], 't': posterior['kappa_q'].shape[1],
+             'tag': posterior['delta_q'].shape[1]}
+    valid = (observed['l'] < sizes['l']) & (observed['t'] < sizes['t']) & (observed['tag'] < sizes['tag']).all(1)
+    data = {key: value[valid].cpu() for key, value in observed.items()}
+    ids, users = torch.unique(data['u'], return_inverse=True)
+
+    log_photo = photo_log_likelihoods(posterior, data)
+    theta = posterior_params.summary(posterior, 'theta', 'mean').float()
+    photos = torch.zeros(len(ids)).index_add_(0, users, torch.ones(len(users)))
+    psi = theta.expand(len(ids), -1)
+    for _ in range(iterations):
+        q = torch.softmax(log_photo + torch.log(psi[users]), 1)
+        counts = torch.zeros(len(ids), len(theta)).index_add_(0, users, q)
+        updated = (prior * theta + counts) / (prior + photos).unsqueeze(1)
+        change = (updated - psi).abs().max().item() if len(ids) else 0.
+        psi = updated
+        if change < TOLERANCE:
+            break
+    return ids, torch.log(psi)
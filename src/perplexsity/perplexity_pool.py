@@ -0,0 +1,109 @@
+# scores every posterior in a model directory with a pool of worker processes, for the perplexity scripts
+#
+#   - each worker runs with its own torch thread budget, the threads of the job split among the workers
+#   - the test set of a data file is parsed once: the first worker that needs it saves the parsed tensors to
+#     TEST_SET_DIR (under a lock), the others load them, and every worker keeps the ones it has loaded
+#   - the parent appends one row per model to a csv results table as soon as it is scored; a restarted run
+#     skips the models the table already has as done or skipped, models that failed are scored again
+
+import csv
+import fcntl
+import hashlib
+import multiprocessing
+import os
+import tempfile
+import time
+import traceback
+
+import torch
+
+import thread_tuning
+
+TEST_SET_DIR = os.path.join(tempfile.gettempdir(), 'uem-test-sets')
+COLUMNS = ['model', 'status', 'model_type', 'test_file', 'word_perplexity_given_user',
+           'location_perplexity_given_user', 'word_tokens_skipped', 'location_tokens_skipped', 'word_perplexity_se',
+           'location_perplexity_se', 'word_samples', 'location_samples', 'seconds', 'error']
+FINISHED = ['done', 'skipped']
+
+_test_sets = {}
+
+
+def test_set(test_file, parse, directory=TEST_SET_DIR):
+    # parse(test_file) once per data file and version of it, shared through directory by all workers
+    if test_file in _test_sets:
+        return _test_sets[test_file]
+    stat = os.stat(test_file)
+    key = hashlib.sha1(f'{os.path.abspath(test_file)}:{stat.st_size}:{stat.st_mtime_ns}'.encode()).hexdigest()
+    path = os.path.join(directory, f'{key}.pt')
+    os.makedirs(directory, exist_ok=True)
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(path):
+            data = torch.load(path)
+        else:
+            data = parse(test_file)
+            torch.save(data, path + '.tmp')
+            os.replace(path + '.tmp', path)
+    _test_sets[test_file] = data
+    return data
+
+
+def finished_models(results):
+    if not os.path.exists(results):
+        return set()
+    with open(results) as f:
+        return {row['model'] for row in csv.DictReader(f) if row['status'] in FINISHED}
+
+
+def _init_worker(threads):
+    thread_tuning.set_threads(threads)
+
+
+def _score(task):
+    # run(model) returns the metrics of the model, or None when it is not scored by this script
+    run, model = task
+    start = time.perf_counter()
+    try:
+        metrics = run(model)
+        row = dict(metrics or {}, status='done' if metrics else 'skipped')
+    except Exception:
+        traceback.print_exc()
+        row = {'status': 'failed', 'error': traceback.format_exc(limit=1).strip().splitlines()[-1]}
+    row.update(model=model, seconds=round(time.perf_counter() - start, 3))
+    return row
+
+
+def evaluate(models, run, results, workers=1, threads=1):
+    # scores the models not finished in results with workers processes of threads // workers threads each
+    done = finished_models(results)
+    todo = [model for model in models if model not in done]
+    print(f'{len(done)} models already in {results}, {len(todo)} to score with {workers} workers')
+    if not todo:
+        return
+
+    new_file = not os.path.exists(results) or not os.path.getsize(results)
+    # a table started by an older version keeps its columns
+    columns = COLUMNS
+    if not new_file:
+        with open(results) as f:
+            columns = next(csv.reader(f), None) or COLUMNS
+    os.makedirs(os.path.dirname(os.path.abspath(results)), exist_ok=True)
+    with open(results, 'a', newline='') as f:
+        writer = csv.DictWriter(f, columns, extrasaction='ignore')
+        if new_file:
+            writer.writeheader()
+        tasks = [(run, model) for model in todo]
+        if workers == 1:
+            rows = map(_score, tasks)
+        else:
+            # spawned, forked workers would inherit the parent's cuda and openmp state
+            pool = multiprocessing.get_context('spawn').Pool(
+                workers, initializer=_init_worker, initargs=(max(1, threads // workers),))
+            rows = pool.imap_unordered(_score, tasks)
+        for i, row in enumerate(rows):
+            writer.writerow(row)
+            f.flush()
+            print(f' {len(done) + i + 1} / {len(models)} {row["model"]}: {row["status"]}')
+        if workers != 1:
+            pool.close()
+            pool.join()